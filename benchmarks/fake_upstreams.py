@@ -0,0 +1,359 @@
+import io
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+DEFAULT_PAGE_LIMIT = 25
+MOSCOW_CENTER = (55.751244, 37.618423)
+
+
+def format_price(amount):
+    return f'{amount / 100:.2f} ₽'
+
+
+def get_price_meta(amount):
+    return {'amount': amount, 'currency': 'RUB', 'formatted': format_price(amount)}
+
+
+def make_image_content():
+    image = Image.new('RGB', (1200, 1200), (230, 120, 40))
+    image_content = io.BytesIO()
+    image.save(image_content, format='JPEG', quality=90)
+    return image_content.getvalue()
+
+
+def make_random_pizzerias(count, seed=0):
+    # Spread over the Moscow region, about 100 x 100 km.
+    random_generator = random.Random(seed)
+    latitude, longitude = MOSCOW_CENTER
+    return [
+        {
+            'id': f'pizzeria-{index}',
+            'alias': f'Пиццерия {index}',
+            'address': f'Москва, улица {index}',
+            'lat': latitude + random_generator.uniform(-0.45, 0.45),
+            'lon': longitude + random_generator.uniform(-0.8, 0.8),
+            'delivery_chat_id': 1000 + index,
+        }
+        for index in range(count)
+    ]
+
+
+class FakeElasticPath:
+    def __init__(self, pizzerias=None):
+        with open(get_data_path('menu.json'), 'r', encoding='utf-8') as menu_file:
+            menu = json.load(menu_file)
+        self.products = []
+        self.files = {}
+        for menu_item in menu:
+            file_id = str(uuid.uuid4())
+            self.files[file_id] = menu_item['product_image']['url']
+            amount = menu_item['price'] * 100
+            self.products.append({
+                'type': 'product',
+                'id': str(uuid.uuid4()),
+                'name': menu_item['name'],
+                'slug': str(menu_item['id']),
+                'sku': str(menu_item['id']),
+                'description': menu_item['description'],
+                'price': [
+                    {'amount': amount, 'currency': 'RUB', 'includes_tax': True}
+                ],
+                'meta': {'display_price': {'with_tax': get_price_meta(amount)}},
+                'relationships': {
+                    'main_image': {'data': {'type': 'main_image', 'id': file_id}}
+                },
+            })
+        self.products_by_id = {
+            product['id']: product for product in self.products
+        }
+        if pizzerias is None:
+            addresses_path = get_data_path('addresses.json')
+            with open(addresses_path, 'r', encoding='utf-8') as addresses_file:
+                addresses = json.load(addresses_file)
+            pizzerias = [
+                {
+                    'id': address['id'],
+                    'alias': address['alias'],
+                    'address': address['address']['full'],
+                    'lat': float(address['coordinates']['lat']),
+                    'lon': float(address['coordinates']['lon']),
+                    'delivery_chat_id': 30952486,
+                }
+                for address in addresses
+            ]
+        self.flows = {'pizzerias': pizzerias}
+        self.carts = {}
+        self.customers = []
+        self.image_content = make_image_content()
+        self.lock = threading.Lock()
+
+    def get_cart(self, cart_id):
+        items = self.carts.get(cart_id, [])
+        total = sum(
+            item['meta']['display_price']['with_tax']['value']['amount']
+            for item in items
+        )
+        return {
+            'data': [dict(item) for item in items],
+            'meta': {'display_price': {'with_tax': get_price_meta(total)}},
+        }
+
+    def add_cart_item(self, cart_id, product_id, quantity):
+        product = self.products_by_id[product_id]
+        unit_amount = product['price'][0]['amount']
+        items = self.carts.setdefault(cart_id, [])
+        for item in items:
+            if item['product_id'] == product_id:
+                item['quantity'] += quantity
+                break
+        else:
+            item = {
+                'id': str(uuid.uuid4()),
+                'type': 'cart_item',
+                'product_id': product_id,
+                'name': product['name'],
+                'quantity': quantity,
+            }
+            items.append(item)
+        item['meta'] = {'display_price': {'with_tax': {
+            'unit': get_price_meta(unit_amount),
+            'value': get_price_meta(unit_amount * item['quantity']),
+        }}}
+
+    def delete_cart_item(self, cart_id, item_id):
+        self.carts[cart_id] = [
+            item for item in self.carts.get(cart_id, [])
+            if item['id'] != item_id
+        ]
+
+    def handle(self, method, path, query, body, base_url):
+        # Returns (status, payload), bytes payloads are sent as they are.
+        path_parts = [part for part in path.split('/') if part]
+        if path == '/oauth/access_token':
+            return 200, {
+                'access_token': uuid.uuid4().hex,
+                'expires': int(time.time()) + 3600,
+            }
+        if path_parts[:1] == ['downloads']:
+            return 200, self.image_content
+        if path_parts[:1] != ['v2'] or len(path_parts) < 2:
+            return 404, {'errors': [{'title': 'Not found'}]}
+        resource, rest = path_parts[1], path_parts[2:]
+        with self.lock:
+            if resource == 'products' and not rest:
+                return 200, self.get_page(self.products, query, base_url, path)
+            if resource == 'products' and method == 'GET':
+                product = self.products_by_id.get(rest[0])
+                if product is None:
+                    return 404, {'errors': [{'title': 'Not found'}]}
+                return 200, {'data': product}
+            if resource == 'files':
+                if rest[0] not in self.files:
+                    return 404, {'errors': [{'title': 'Not found'}]}
+                return 200, {'data': {
+                    'id': rest[0],
+                    'link': {'href': f'{base_url}/downloads/{rest[0]}.jpg'},
+                }}
+            if resource == 'carts':
+                cart_id = rest[0]
+                if method == 'POST':
+                    self.add_cart_item(
+                        cart_id,
+                        body['data']['id'],
+                        body['data']['quantity']
+                    )
+                elif method == 'DELETE':
+                    self.delete_cart_item(cart_id, rest[2])
+                return 200, self.get_cart(cart_id)
+            if resource == 'customers':
+                customer = dict(body['data'], id=str(uuid.uuid4()))
+                self.customers.append(customer)
+                return 201, {'data': customer}
+            if resource == 'flows' and len(rest) >= 2:
+                entries = self.flows.get(rest[0], [])
+                if len(rest) == 2:
+                    return 200, self.get_page(entries, query, base_url, path)
+                for entry in entries:
+                    if entry['id'] == rest[2]:
+                        return 200, {'data': entry}
+        return 404, {'errors': [{'title': 'Not found'}]}
+
+    @staticmethod
+    def get_page(objects, query, base_url, path):
+        # Same paging as the real API: 25 objects unless asked otherwise.
+        limit = int(query.get('page[limit]', [DEFAULT_PAGE_LIMIT])[0])
+        offset = int(query.get('page[offset]', [0])[0])
+        page = {
+            'data': objects[offset:offset + limit],
+            'links': {},
+            'meta': {
+                'page': {'limit': limit, 'offset': offset},
+                'results': {'total': len(objects)},
+            },
+        }
+        if offset + limit < len(objects):
+            page['links']['next'] = (
+                f'{base_url}{path}?page[limit]={limit}'
+                f'&page[offset]={offset + limit}'
+            )
+        return page
+
+
+class FakeGeocoder:
+    def handle(self, method, path, query, body, base_url):
+        address = query.get('geocode', [''])[0]
+        if 'нигде' in address.lower():
+            return 200, {'response': {'GeoObjectCollection': {
+                'featureMember': []
+            }}}
+        # Every address gets stable coordinates near the city center.
+        random_generator = random.Random(address)
+        latitude = MOSCOW_CENTER[0] + random_generator.uniform(-0.2, 0.2)
+        longitude = MOSCOW_CENTER[1] + random_generator.uniform(-0.3, 0.3)
+        return 200, {'response': {'GeoObjectCollection': {'featureMember': [
+            {'GeoObject': {'Point': {'pos': f'{longitude} {latitude}'}}}
+        ]}}}
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_chat_id(body):
+        if isinstance(body, dict):
+            return int(body.get('chat_id', 0))
+        found = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body or b'')
+        return int(found.group(1)) if found else 0
+
+    def make_message(self, chat_id, **fields):
+        return {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Pizza'},
+            **fields,
+        }
+
+    def handle(self, method, path, query, body, base_url):
+        api_method = path.rsplit('/', 1)[-1]
+        with self.lock:
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        chat_id = self.get_chat_id(body)
+        if api_method == 'getMe':
+            result = {
+                'id': 1,
+                'is_bot': True,
+                'first_name': 'Pizza',
+                'username': 'pizza_benchmark_bot',
+            }
+        elif api_method in ('deleteMessage', 'answerCallbackQuery',
+                            'answerPreCheckoutQuery', 'setWebhook'):
+            result = True
+        elif api_method == 'sendPhoto':
+            file_id = uuid.uuid4().hex
+            result = self.make_message(chat_id, photo=[{
+                'file_id': file_id,
+                'file_unique_id': file_id[:16],
+                'width': 800,
+                'height': 800,
+            }])
+        else:
+            result = self.make_message(chat_id, text='')
+        return 200, {'ok': True, 'result': result}
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, with Nagle's algorithm on
+    # every keep-alive response would wait for a delayed ACK.
+    disable_nagle_algorithm = True
+
+    def __init__(self, *args, upstream, latency, **kwargs):
+        self.upstream = upstream
+        self.latency = latency
+        super().__init__(*args, **kwargs)
+
+    def handle_request(self, method):
+        content_length = int(self.headers.get('Content-Length', 0))
+        raw_body = self.rfile.read(content_length) if content_length else b''
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json') and raw_body:
+            body = json.loads(raw_body)
+        elif content_type.startswith('application/x-www-form-urlencoded'):
+            body = {
+                key: values[0]
+                for key, values in parse_qs(raw_body.decode()).items()
+            }
+        else:
+            body = raw_body
+        split_url = urlsplit(self.path)
+        host, port = self.server.server_address[:2]
+        if self.latency:
+            time.sleep(self.latency)
+        status, payload = self.upstream.handle(
+            method,
+            split_url.path,
+            parse_qs(split_url.query),
+            body,
+            f'http://{host}:{port}'
+        )
+        if isinstance(payload, bytes):
+            response_body = payload
+            response_type = 'image/jpeg'
+        else:
+            response_body = json.dumps(payload).encode()
+            response_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', response_type)
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeUpstreamServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections opened at once, and the
+    # client retries them only after a second.
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def start_fake_upstream(upstream, latency=0.0):
+    handler = partial(FakeUpstreamHandler, upstream=upstream, latency=latency)
+    server = FakeUpstreamServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    return server, f'http://{host}:{port}'
+
+
+def get_data_path(file_name):
+    return Path(Path(__file__).resolve().parent.parent, file_name)
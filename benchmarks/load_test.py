@@ -0,0 +1,449 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from queue import Queue
+
+from telegram import Update
+from telegram.ext import ConversationHandler, Defaults, Dispatcher, ExtBot
+from telegram.utils.request import Request
+
+import metrics
+from benchmarks.fake_upstreams import (FakeElasticPath,
+                                       FakeGeocoder,
+                                       FakeTelegram,
+                                       start_fake_upstream)
+from pending_updates import resolve_pending_state
+
+BENCHMARK_TOKEN = '123456:benchmark'
+PERCENTILES = (50, 90, 99)
+ADDRESSES = [f'Москва, Тверская улица, дом {number}' for number in range(60)]
+
+
+def get_redis(redis_url, use_fake_redis):
+    if use_fake_redis:
+        import fakeredis
+        return fakeredis.FakeRedis()
+    import redis
+    return redis.Redis.from_url(redis_url)
+
+
+class BenchmarkUser:
+    update_ids = itertools.count(1)
+
+    def __init__(self, user_id, products, random_generator):
+        self.user_id = user_id
+        self.products = products
+        self.random_generator = random_generator
+        self.message_ids = itertools.count(1)
+        self.has_contact_info = False
+        self.product = None
+
+    def get_user(self):
+        return {'id': self.user_id, 'is_bot': False, 'first_name': 'Гость'}
+
+    def get_message(self, **fields):
+        return {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+            'from': self.get_user(),
+            **fields,
+        }
+
+    def send_text(self, text):
+        message = self.get_message(text=text)
+        if text.startswith('/'):
+            message['entities'] = [
+                {'type': 'bot_command', 'offset': 0, 'length': len(text)}
+            ]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def press_button(self, data, **message_fields):
+        return {
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'from': self.get_user(),
+                'chat_instance': str(self.user_id),
+                'data': data,
+                'message': self.get_message(**message_fields),
+            },
+        }
+
+    def send_payment(self):
+        return {'update_id': next(self.update_ids), 'message': self.get_message(
+            successful_payment={
+                'currency': 'RUB',
+                'total_amount': 100000,
+                'invoice_payload': 'order_payment',
+                'telegram_payment_charge_id': 'telegram-charge',
+                'provider_payment_charge_id': 'provider-charge',
+            }
+        )}
+
+    def open_product(self):
+        self.product = self.random_generator.choice(self.products)
+        return self.press_button(self.product['id'], text='Меню')
+
+    def add_product(self):
+        caption = '\n\n'.join([
+            self.product['name'],
+            self.product['meta']['display_price']['with_tax']['formatted'],
+            self.product['description'],
+        ])
+        return self.press_button(self.product['id'], caption=caption)
+
+    # Every script starts and ends in the main menu.
+    def browse(self):
+        yield self.press_button('page_2', text='Меню')
+        yield self.press_button('page_1', text='Меню')
+        yield self.open_product()
+        yield self.press_button('main_menu', caption='Пицца')
+
+    def fill_cart(self):
+        yield self.open_product()
+        yield self.add_product()
+        yield self.press_button('cart', caption='Пицца')
+        yield self.press_button('main_menu', text='Корзина')
+
+    def quick_taps(self):
+        # The cart button is pressed before adding to cart is answered.
+        yield self.open_product()
+        yield [self.add_product(), self.press_button('cart', caption='Пицца')]
+        yield self.press_button('main_menu', text='Корзина')
+
+    def check_out(self):
+        yield self.open_product()
+        yield self.add_product()
+        yield self.press_button('cart', caption='Пицца')
+        yield self.press_button('order', text='Корзина')
+        if not self.has_contact_info:
+            yield self.send_text(f'Гость {self.user_id}')
+            yield self.send_text(f'guest{self.user_id}@example.com')
+            self.has_contact_info = True
+        yield self.send_text(self.random_generator.choice(ADDRESSES))
+        yield self.press_button('delivery_pickup', text='Доставка')
+        yield self.send_payment()
+
+
+SCRIPTS = {
+    'browse': BenchmarkUser.browse,
+    'fill_cart': BenchmarkUser.fill_cart,
+    'quick_taps': BenchmarkUser.quick_taps,
+    'check_out': BenchmarkUser.check_out,
+}
+DEFAULT_SCRIPT_WEIGHTS = {
+    'browse': 5,
+    'fill_cart': 3,
+    'quick_taps': 1,
+    'check_out': 2,
+}
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, state_name, seconds):
+        with self.lock:
+            self.latencies.setdefault(state_name, []).append(seconds)
+
+    def record_error(self, state_name):
+        with self.lock:
+            self.errors[state_name] = self.errors.get(state_name, 0) + 1
+
+
+def get_percentile(sorted_values, percentile):
+    index = max(round(percentile / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def get_state_name(conversation_handler, user_id):
+    state = resolve_pending_state(
+        conversation_handler.conversations.get((user_id, user_id))
+    )
+    if state is None:
+        return 'entry'
+    return getattr(state, 'name', str(state))
+
+
+def run_user(dispatcher, conversation_handler, recorder, user, scripts_count,
+             script_weights, current_states, dispatch_lock):
+    script_names = list(script_weights)
+    weights = [script_weights[script_name] for script_name in script_names]
+    scripts = [
+        SCRIPTS[script_name](user) for script_name in
+        user.random_generator.choices(script_names, weights, k=scripts_count)
+    ]
+    conversation_key = (user.user_id, user.user_id)
+    for updates_data in itertools.chain([user.send_text('/start')], *scripts):
+        # A list stands for taps sent without waiting for an answer.
+        if isinstance(updates_data, dict):
+            updates_data = [updates_data]
+        state_name = get_state_name(conversation_handler, user.user_id)
+        current_states[user.user_id] = state_name
+        started_at = time.perf_counter()
+        for update_data in updates_data:
+            update = Update.de_json(update_data, dispatcher.bot)
+            # Updater has a single dispatcher thread.
+            with dispatch_lock:
+                dispatcher.process_update(update)
+        # With run_async the handlers are still running in the pool.
+        resolve_pending_state(
+            conversation_handler.conversations.get(conversation_key)
+        )
+        for _ in updates_data:
+            recorder.record(state_name, time.perf_counter() - started_at)
+
+
+def get_handled_updates_count():
+    with metrics.METRICS_LOCK:
+        return sum(
+            count for (metric_name, _), (_, _, count)
+            in metrics.HISTOGRAMS.items()
+            if metric_name == 'bot_handler_duration_seconds'
+        )
+
+
+def set_up_bot(args, redis_db, urls):
+    # Imported late, bot.py reads upstream URLs from the environment.
+    import bot
+    from outbound_queue import QueuedBot
+    from redis_hash_persistence import RedisHashPersistence
+
+    telegram_bot_class = QueuedBot if args.send_limits else ExtBot
+    telegram_bot = telegram_bot_class(
+        BENCHMARK_TOKEN,
+        base_url=f'{urls["telegram"]}/bot',
+        request=Request(con_pool_size=args.users + args.workers + 4),
+        defaults=Defaults(run_async=args.run_async)
+    )
+    if args.send_limits:
+        telegram_bot.outbound_queue.start_workers()
+    dispatcher = Dispatcher(
+        telegram_bot,
+        Queue(),
+        workers=args.workers,
+        persistence=RedisHashPersistence(redis_db)
+    )
+    # Updates are passed to process_update directly, the dispatcher thread
+    # is only started for its pool of handler workers.
+    dispatcher_ready = threading.Event()
+    threading.Thread(
+        target=dispatcher.start,
+        kwargs={'ready': dispatcher_ready},
+        daemon=True
+    ).start()
+    dispatcher_ready.wait()
+    bot.add_handlers(
+        dispatcher,
+        redis_db,
+        'benchmark-geocoder-key',
+        'benchmark-provider-token',
+        []
+    )
+    bot.start_order_workers(redis_db, telegram_bot)
+    if not args.cold:
+        bot.get_elastic_path_access_token()
+        bot.get_main_menu()
+        bot.load_pizzerias()
+    conversation_handler = next(
+        handler
+        for handlers in dispatcher.handlers.values()
+        for handler in handlers
+        if isinstance(handler, ConversationHandler)
+    )
+    return dispatcher, conversation_handler
+
+
+def summarize(recorder, elapsed):
+    states = {}
+    for state_name, latencies in sorted(recorder.latencies.items()):
+        latencies = sorted(latencies)
+        state_summary = {
+            'updates': len(latencies),
+            'errors': recorder.errors.get(state_name, 0),
+            'throughput': len(latencies) / elapsed,
+            'max_ms': latencies[-1] * 1000,
+        }
+        for percentile in PERCENTILES:
+            state_summary[f'p{percentile}_ms'] = \
+                get_percentile(latencies, percentile) * 1000
+        states[state_name] = state_summary
+    updates_count = sum(state['updates'] for state in states.values())
+    return {
+        'elapsed_seconds': elapsed,
+        'updates': updates_count,
+        'unhandled': updates_count - get_handled_updates_count(),
+        'errors': sum(recorder.errors.values()),
+        'throughput': updates_count / elapsed,
+        'states': states,
+    }
+
+
+def format_change(value, baseline_value):
+    if not baseline_value:
+        return ''
+    return f' ({(value - baseline_value) / baseline_value:+.0%})'
+
+
+def print_summary(summary, baseline=None):
+    baseline_states = baseline['states'] if baseline else {}
+    print(f'{"state":<22}{"updates":>9}{"errors":>8}{"upd/s":>10}'
+          f'{"p50 ms":>18}{"p90 ms":>18}{"p99 ms":>18}')
+    for state_name, state in summary['states'].items():
+        baseline_state = baseline_states.get(state_name, {})
+        percentiles = ''.join(
+            '{:>18}'.format(
+                f'{state[f"p{percentile}_ms"]:.1f}' + format_change(
+                    state[f'p{percentile}_ms'],
+                    baseline_state.get(f'p{percentile}_ms')
+                )
+            )
+            for percentile in PERCENTILES
+        )
+        print(f'{state_name:<22}{state["updates"]:>9}{state["errors"]:>8}'
+              f'{state["throughput"]:>10.1f}{percentiles}')
+    throughput_change = format_change(
+        summary['throughput'],
+        baseline['throughput'] if baseline else None
+    )
+    print(f'\n{summary["updates"]} updates in '
+          f'{summary["elapsed_seconds"]:.1f} s, '
+          f'{summary["throughput"]:.1f} updates/s{throughput_change}, '
+          f'{summary["errors"]} errors, '
+          f'{summary["unhandled"]} updates not handled')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay conversations through the bot handlers against '
+                    'local fake Elastic Path, geocoder and Telegram servers'
+    )
+    parser.add_argument('--users', type=int, default=20,
+                        help='number of users talking to the bot at once')
+    parser.add_argument('--scripts', type=int, default=5,
+                        help='conversation scripts replayed by every user')
+    parser.add_argument('--elastic-path-latency', type=float, default=50,
+                        help='fake Elastic Path response time, ms')
+    parser.add_argument('--geocoder-latency', type=float, default=30,
+                        help='fake geocoder response time, ms')
+    parser.add_argument('--telegram-latency', type=float, default=20,
+                        help='fake Telegram Bot API response time, ms')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15',
+                        help='disposable Redis database, it is flushed '
+                             'before the run')
+    parser.add_argument('--fake-redis', action='store_true',
+                        help='use an in-process fakeredis instead')
+    parser.add_argument('--cold', action='store_true',
+                        help='do not warm up the token, menu and pizzerias')
+    parser.add_argument('--send-limits', action='store_true',
+                        help='send through the outbound queue with '
+                             'Telegram flood limits')
+    parser.add_argument('--run-async', action='store_true',
+                        help='run handlers in the worker pool, as the bot '
+                             'does with BOT_RUN_ASYNC=true')
+    parser.add_argument('--workers', type=int, default=32,
+                        help='handler worker threads for --run-async')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--baseline',
+                        help='compare with results saved by --output')
+    args = parser.parse_args()
+
+    elastic_path = FakeElasticPath()
+    servers = {
+        'elastic_path': start_fake_upstream(
+            elastic_path,
+            args.elastic_path_latency / 1000
+        ),
+        'geocoder': start_fake_upstream(
+            FakeGeocoder(),
+            args.geocoder_latency / 1000
+        ),
+        'telegram': start_fake_upstream(
+            FakeTelegram(),
+            args.telegram_latency / 1000
+        ),
+    }
+    urls = {name: url for name, (_, url) in servers.items()}
+    os.environ.update({
+        'ELASTIC_PATH_API_URL': urls['elastic_path'],
+        'ELASTIC_PATH_CLIENT_ID': 'benchmark',
+        'ELASTIC_PATH_CLIENT_SECRET': 'benchmark',
+        'YANDEX_GEOCODER_URL': urls['geocoder'],
+        'ELASTIC_PATH_POOL_SIZE': str(args.users + 4),
+    })
+    # Product photos are prepared in ./images, keep them out of the repo.
+    working_directory = tempfile.TemporaryDirectory()
+    os.chdir(working_directory.name)
+    redis_db = get_redis(args.redis_url, args.fake_redis)
+    redis_db.flushdb()
+    dispatcher, conversation_handler = set_up_bot(args, redis_db, urls)
+    recorder = LatencyRecorder()
+    current_states = {}
+
+    def record_error(update, context):
+        if isinstance(update, Update) and update.effective_user:
+            state_name = current_states.get(update.effective_user.id, 'entry')
+        else:
+            state_name = 'unknown'
+        recorder.record_error(state_name)
+
+    dispatcher.add_error_handler(record_error)
+    dispatch_lock = threading.Lock()
+    random_generator = random.Random(args.seed)
+    users = [
+        BenchmarkUser(
+            user_id,
+            elastic_path.products,
+            random.Random(random_generator.random())
+        )
+        for user_id in range(100001, 100001 + args.users)
+    ]
+    threads = [
+        threading.Thread(target=run_user, args=(
+            dispatcher,
+            conversation_handler,
+            recorder,
+            user,
+            args.scripts,
+            DEFAULT_SCRIPT_WEIGHTS,
+            current_states,
+            dispatch_lock,
+        ))
+        for user in users
+    ]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = summarize(recorder, time.perf_counter() - started_at)
+    summary['config'] = {
+        key: value for key, value in vars(args).items()
+        if key not in ('output', 'baseline')
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_summary(summary, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(summary, output_file, indent=2)
+    for server, _ in servers.values():
+        server.shutdown()
+    working_directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
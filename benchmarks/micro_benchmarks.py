@@ -0,0 +1,499 @@
+import argparse
+import itertools
+import os
+import random
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from geopy import distance
+from telegram.error import RetryAfter
+
+import bot
+import elastic_path_api
+import follow_ups
+import geo_distances
+import pizzeria_locator
+import reply_markups_and_message_texts
+from benchmarks.fake_upstreams import (MOSCOW_CENTER,
+                                       FakeElasticPath,
+                                       make_random_pizzerias,
+                                       start_fake_upstream)
+from benchmarks.load_test import get_redis
+from catalog_cache import get_catalog_hash
+from redis_hash_persistence import RedisHashPersistence
+from telegram_file_cache import save_photo_file_id
+
+
+def get_random_positions(count, seed=1):
+    random_generator = random.Random(seed)
+    latitude, longitude = MOSCOW_CENTER
+    return [
+        (
+            latitude + random_generator.uniform(-0.3, 0.3),
+            longitude + random_generator.uniform(-0.5, 0.5)
+        )
+        for _ in range(count)
+    ]
+
+
+def find_nearest_pizzeria_by_scan(pizzerias, position):
+    # The way the bot searched before the index: geodesic distance to all.
+    return min(
+        pizzerias,
+        key=lambda pizzeria: distance.distance(
+            position,
+            (pizzeria['lat'], pizzeria['lon'])
+        ).km
+    )
+
+
+def measure(function, arguments):
+    started_at = time.perf_counter()
+    for argument in arguments:
+        function(argument)
+    return (time.perf_counter() - started_at) / len(arguments)
+
+
+def benchmark_locator(sizes, queries_count):
+    print(f'{"pizzerias":>10}{"build ms":>12}{"index us":>12}{"scan us":>14}')
+    for size in sizes:
+        pizzerias = make_random_pizzerias(size)
+        # The index is built from entries as they come from Elastic Path.
+        pizzeria_locator.get_all_entries = lambda flow_slug: pizzerias
+        started_at = time.perf_counter()
+        pizzeria_locator.load_pizzerias()
+        build_seconds = time.perf_counter() - started_at
+        positions = get_random_positions(queries_count)
+        index_seconds = measure(
+            pizzeria_locator.find_nearest_pizzeria,
+            positions
+        )
+        # A full geodesic scan of 100k entries takes seconds, a few
+        # queries are enough to see the difference.
+        scan_positions = positions[:max(1, queries_count * 100 // size)]
+        scan_seconds = measure(
+            lambda position: find_nearest_pizzeria_by_scan(pizzerias, position),
+            scan_positions
+        )
+        print(f'{size:>10}{build_seconds * 1000:>12.1f}'
+              f'{index_seconds * 1e6:>12.1f}{scan_seconds * 1e6:>14.1f}')
+
+
+def measure_persistence_memory(redis_db, users_count, loaded_users):
+    # Only memory taken after this point is counted, the stored users
+    # may live in this process with fakeredis.
+    tracemalloc.start()
+    persistence = RedisHashPersistence(redis_db)
+    user_data = persistence.get_user_data()
+    startup_memory, _ = tracemalloc.get_traced_memory()
+    for user_id in loaded_users:
+        persistence.update_user_data(user_id, user_data[user_id])
+    loaded_users_memory, _ = tracemalloc.get_traced_memory()
+    # What a persistence that loads everyone on start keeps in memory.
+    for user_id in range(users_count):
+        persistence.update_user_data(user_id, user_data[user_id])
+    all_users_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return startup_memory, loaded_users_memory, all_users_memory
+
+
+def benchmark_persistence(redis_db, users_count, changed_users_count):
+    redis_db.flushdb()
+    pipeline = redis_db.pipeline(transaction=False)
+    for user_id in range(users_count):
+        pipeline.hset(f'bot:user_data:{user_id}', mapping={
+            'name': f'"Гость {user_id}"',
+            'email': f'"guest{user_id}@example.com"',
+            'latitude': '55.75',
+            'longitude': '37.61',
+        })
+    pipeline.execute()
+
+    started_at = time.perf_counter()
+    persistence = RedisHashPersistence(redis_db)
+    user_data = persistence.get_user_data()
+    startup_seconds = time.perf_counter() - started_at
+
+    changed_users = random.Random(2).sample(
+        range(users_count),
+        changed_users_count
+    )
+    started_at = time.perf_counter()
+    for user_id in changed_users:
+        user_data[user_id]['delivery_type'] = 'pickup'
+        persistence.update_user_data(user_id, user_data[user_id])
+    update_seconds = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    for user_id in changed_users:
+        persistence.update_user_data(user_id, user_data[user_id])
+    unchanged_seconds = time.perf_counter() - started_at
+
+    startup_memory, changed_users_memory, all_users_memory = \
+        measure_persistence_memory(redis_db, users_count, changed_users)
+
+    print(f'{users_count} stored users')
+    print(f'startup: {startup_seconds * 1000:.1f} ms, '
+          f'{startup_memory / 1024:.0f} KiB')
+    print(f'load and update one field: '
+          f'{update_seconds / changed_users_count * 1e6:.1f} us per user')
+    print(f'flush without changes: '
+          f'{unchanged_seconds / changed_users_count * 1e6:.1f} us per user')
+    print(f'memory with {changed_users_count} users loaded: '
+          f'{changed_users_memory / 1024 ** 2:.1f} MiB, '
+          f'with all users loaded: {all_users_memory / 1024 ** 2:.1f} MiB')
+
+
+def benchmark_distance_kernels(sizes, origins_count, repeats=20):
+    # One customer against all pizzerias, and many customers at once.
+    origins = get_random_positions(origins_count)
+    print(f'{"pizzerias":>10}{"1xN us":>12}'
+          f'{f"{origins_count}xN ms":>12}{"ns per pair":>14}')
+    for size in sizes:
+        destinations = [
+            (pizzeria['lat'], pizzeria['lon'])
+            for pizzeria in make_random_pizzerias(size)
+        ]
+        single_seconds = measure(
+            lambda origin: geo_distances.haversine_distances(
+                origin,
+                destinations
+            ),
+            origins[:repeats]
+        )
+        started_at = time.perf_counter()
+        geo_distances.pairwise_haversine_distances(origins, destinations)
+        pairwise_seconds = time.perf_counter() - started_at
+        print(f'{size:>10}{single_seconds * 1e6:>12.1f}'
+              f'{pairwise_seconds * 1000:>12.1f}'
+              f'{pairwise_seconds / (origins_count * size) * 1e9:>14.2f}')
+
+
+def make_random_products(count, categories_count=10, seed=1):
+    random_generator = random.Random(seed)
+    products = []
+    for index in range(count):
+        category_id = random_generator.randrange(categories_count)
+        products.append({
+            'id': f'product-{index}',
+            'name': f'Пицца {index}',
+            'relationships': {'categories': {'data': [
+                {'type': 'category', 'id': f'category-{category_id}'}
+            ]}},
+        })
+    return products
+
+
+def benchmark_menu(products_count, flips_count, seed=1):
+    products = make_random_products(products_count)
+    started_at = time.perf_counter()
+    catalog_hash = get_catalog_hash(products)
+    hash_seconds = time.perf_counter() - started_at
+    random_generator = random.Random(seed)
+    print(f'{products_count} products, catalog hash in '
+          f'{hash_seconds * 1000:.1f} ms')
+    print(f'{"grouping":>10}{"pages":>8}{"build ms":>12}'
+          f'{"flip us":>10}{"uncached us":>14}')
+    for group_by_category in (False, True):
+        started_at = time.perf_counter()
+        pages = reply_markups_and_message_texts.build_main_menu_pages(
+            products,
+            group_by_category=group_by_category
+        )
+        build_seconds = time.perf_counter() - started_at
+        flips = [
+            random_generator.randint(1, len(pages))
+            for _ in range(flips_count)
+        ]
+        get_menu_page = reply_markups_and_message_texts \
+            .get_main_menu_reply_markup
+        # The first flip builds the pages for this catalog version.
+        get_menu_page(
+            products,
+            catalog_hash=catalog_hash,
+            group_by_category=group_by_category
+        )
+        flip_seconds = measure(
+            lambda page: get_menu_page(
+                products,
+                page=page,
+                catalog_hash=catalog_hash,
+                group_by_category=group_by_category
+            ),
+            flips
+        )
+        # Without a catalog hash every flip builds the pages again.
+        uncached_seconds = measure(
+            lambda page: get_menu_page(
+                products,
+                page=page,
+                group_by_category=group_by_category
+            ),
+            flips[:max(1, flips_count // 100)]
+        )
+        print(f'{"category" if group_by_category else "none":>10}'
+              f'{len(pages):>8}{build_seconds * 1000:>12.1f}'
+              f'{flip_seconds * 1e6:>10.2f}{uncached_seconds * 1e6:>14.1f}')
+
+
+def benchmark_pagination(entries_count, latency):
+    server, url = start_fake_upstream(
+        FakeElasticPath(pizzerias=make_random_pizzerias(entries_count)),
+        latency
+    )
+    os.environ['ELASTIC_PATH_API_URL'] = url
+    # tests/test_pagination.py checks that every entry comes once.
+    started_at = time.perf_counter()
+    for _ in elastic_path_api.iterate_entries('pizzerias'):
+        # Stands for work done on every entry, like writing an export.
+        time.sleep(latency / elastic_path_api.PAGE_LIMIT)
+    streaming_seconds = time.perf_counter() - started_at
+    server.shutdown()
+    pages_count = -(-entries_count // elastic_path_api.PAGE_LIMIT)
+    print(f'{entries_count} entries in {pages_count} pages streamed in '
+          f'{streaming_seconds:.2f} s, '
+          f'{pages_count * latency * 2:.2f} s without prefetch')
+
+
+def fetch_product_timed(product_id):
+    url = elastic_path_api.get_api_url(f'/v2/products/{product_id}')
+    started_at = time.perf_counter()
+    response = elastic_path_api.make_request('GET', url)
+    response.raise_for_status()
+    return time.perf_counter() - started_at
+
+
+def benchmark_connection_pool(requests_count, threads_count, latency):
+    upstream = FakeElasticPath()
+    server, url = start_fake_upstream(upstream, latency)
+    os.environ['ELASTIC_PATH_API_URL'] = url
+    product_ids = [
+        upstream.products[index % len(upstream.products)]['id']
+        for index in range(requests_count)
+    ]
+    print(f'{"connections":>12}{"requests/s":>12}{"p50 ms":>10}{"p99 ms":>10}')
+    for pooling in ('true', 'false'):
+        os.environ['ELASTIC_PATH_POOLING'] = pooling
+        with ThreadPoolExecutor(max_workers=threads_count) as executor:
+            started_at = time.perf_counter()
+            durations = sorted(
+                executor.map(fetch_product_timed, product_ids)
+            )
+            total_seconds = time.perf_counter() - started_at
+        print(f'{"pooled" if pooling == "true" else "per request":>12}'
+              f'{requests_count / total_seconds:>12.0f}'
+              f'{durations[len(durations) // 2] * 1000:>10.2f}'
+              f'{durations[int(len(durations) * 0.99)] * 1000:>10.2f}')
+    del os.environ['ELASTIC_PATH_POOLING']
+    server.shutdown()
+
+
+class StubTelegramBot:
+    def send_photo(self, chat_id, photo, caption, reply_markup):
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=photo)])
+
+    def delete_message(self, chat_id, message_id):
+        pass
+
+
+def benchmark_product_details(redis_db, views_count, latency):
+    # Product details read the product and the cart. Every view is made
+    # by a new chat, so the cart is not in the mirror yet. Photos are
+    # already uploaded to Telegram and only take a Redis read.
+    upstream = FakeElasticPath()
+    server, url = start_fake_upstream(upstream, latency)
+    os.environ['ELASTIC_PATH_API_URL'] = url
+    for product in upstream.products:
+        image_id = product['relationships']['main_image']['data']['id']
+        save_photo_file_id(
+            redis_db,
+            product['id'],
+            image_id,
+            f'photo-{image_id}'
+        )
+    # The token request is not part of any view.
+    elastic_path_api.get_elastic_path_access_token()
+    context = SimpleNamespace(bot=StubTelegramBot())
+    chat_ids = itertools.count(1)
+    print(f'product details with {latency * 1000:.0f} ms upstream latency')
+    print(f'{"cart read":>12}{"p50 ms":>10}{"p99 ms":>10}')
+    for fanout in ('true', 'false'):
+        os.environ['UPSTREAM_FANOUT'] = fanout
+        durations = []
+        for view_number in range(views_count):
+            product = upstream.products[view_number % len(upstream.products)]
+            chat_id = next(chat_ids)
+            update = SimpleNamespace(callback_query=SimpleNamespace(
+                data=product['id'],
+                message=SimpleNamespace(chat_id=chat_id, message_id=1)
+            ))
+            started_at = time.perf_counter()
+            bot.send_product_details(update, context, redis_db)
+            durations.append(time.perf_counter() - started_at)
+        durations.sort()
+        print(f'{"concurrent" if fanout == "true" else "inline":>12}'
+              f'{durations[len(durations) // 2] * 1000:>10.1f}'
+              f'{durations[int(len(durations) * 0.99)] * 1000:>10.1f}')
+    del os.environ['UPSTREAM_FANOUT']
+    server.shutdown()
+
+
+class SimulatedClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class RecordingBot:
+    def __init__(self, clock, retry_after_every):
+        self.clock = clock
+        self.retry_after_every = retry_after_every
+        self.calls_count = 0
+        self.sent_at = {}
+        self.sent_count = 0
+
+    def send_message(self, chat_id, text):
+        self.calls_count += 1
+        if self.calls_count % self.retry_after_every == 0:
+            raise RetryAfter(3)
+        self.sent_count += 1
+        self.sent_at.setdefault(chat_id, self.clock.time())
+
+
+def benchmark_follow_ups(redis_db, follow_ups_count, workers_count):
+    # Runs the follow-up workers on a simulated clock: an hour of
+    # follow-ups takes seconds. tests/test_follow_ups.py checks that they
+    # are sent once, in time and within the rate limit.
+    redis_db.flushdb()
+    clock = SimulatedClock()
+    bot = RecordingBot(clock, retry_after_every=1000)
+    random_generator = random.Random(3)
+    due_at = {}
+    pipeline = redis_db.pipeline(transaction=False)
+    for chat_id in range(follow_ups_count):
+        delay = random_generator.uniform(0, follow_ups.FOLLOW_UP_DELAY)
+        due_at[chat_id] = clock.time() + delay
+        pipeline.zadd(
+            follow_ups.FOLLOW_UPS_KEY,
+            {f'{chat_id}-follow-up:{chat_id}': due_at[chat_id]}
+        )
+    pipeline.execute()
+
+    claim_due_follow_ups = redis_db.register_script(
+        follow_ups.CLAIM_DUE_FOLLOW_UPS_SCRIPT
+    )
+    started_at = time.perf_counter()
+    simulated_start = clock.time()
+    while redis_db.zcard(follow_ups.FOLLOW_UPS_KEY):
+        # Workers take turns, as if they ran in separate processes.
+        sent_count = sum(
+            follow_ups.send_due_follow_ups(
+                redis_db,
+                bot,
+                claim_due_follow_ups,
+                clock.time,
+                clock.sleep
+            )
+            for _ in range(workers_count)
+        )
+        if sent_count < follow_ups.BATCH_SIZE:
+            clock.sleep(follow_ups.POLL_INTERVAL)
+    wall_seconds = time.perf_counter() - started_at
+
+    busiest_second_count = max(
+        Counter(int(sent_at) for sent_at in bot.sent_at.values()).values()
+    )
+    delays = sorted(
+        sent_at - due_at[chat_id] for chat_id, sent_at in bot.sent_at.items()
+    )
+    print(f'{follow_ups_count} follow-ups due within '
+          f'{follow_ups.FOLLOW_UP_DELAY} s sent in '
+          f'{clock.time() - simulated_start:.0f} simulated s '
+          f'({wall_seconds:.1f} s of real time), '
+          f'{bot.calls_count - bot.sent_count} rate limit answers')
+    print(f'delay after due time: p50 {delays[len(delays) // 2]:.1f} s, '
+          f'max {delays[-1]:.1f} s, '
+          f'at most {busiest_second_count} messages per second')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the pizzeria index, distance kernels, the '
+                    'menu pages, paged Elastic Path reads, '
+                    'the Elastic Path connection pool, product details, '
+                    'the Redis persistence and the follow-up scheduler '
+                    'without running the whole bot'
+    )
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 10000, 100000],
+                        help='numbers of pizzerias to index')
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='nearest pizzeria lookups for every size')
+    parser.add_argument('--origins', type=int, default=100,
+                        help='customers measured at once against all '
+                             'pizzerias')
+    parser.add_argument('--products', type=int, default=1000,
+                        help='products in the menu')
+    parser.add_argument('--flips', type=int, default=10000,
+                        help='menu page flips')
+    parser.add_argument('--users', type=int, default=100000,
+                        help='users stored in the persistence')
+    parser.add_argument('--changed-users', type=int, default=1000,
+                        help='users whose data is loaded and updated')
+    parser.add_argument('--entries', type=int, default=5000,
+                        help='flow entries served by the fake Elastic Path')
+    parser.add_argument('--page-latency', type=float, default=50,
+                        help='fake Elastic Path response time, ms')
+    parser.add_argument('--pool-requests', type=int, default=5000,
+                        help='product requests made with and without '
+                             'the connection pool')
+    parser.add_argument('--pool-threads', type=int, default=16,
+                        help='threads making the product requests')
+    parser.add_argument('--product-views', type=int, default=200,
+                        help='product details shown with and without '
+                             'concurrent upstream reads')
+    parser.add_argument('--upstream-latency', type=float, default=50,
+                        help='fake Elastic Path response time for product '
+                             'details, ms')
+    parser.add_argument('--follow-ups', type=int, default=20000,
+                        help='follow-ups scheduled within an hour')
+    parser.add_argument('--follow-up-workers', type=int, default=2,
+                        help='follow-up workers taking turns')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15',
+                        help='disposable Redis database, it is flushed '
+                             'before the run')
+    parser.add_argument('--fake-redis', action='store_true',
+                        help='use an in-process fakeredis instead')
+    args = parser.parse_args()
+    benchmark_locator(args.sizes, args.queries)
+    print()
+    benchmark_distance_kernels(args.sizes, args.origins)
+    print()
+    benchmark_menu(args.products, args.flips)
+    print()
+    benchmark_pagination(args.entries, args.page_latency / 1000)
+    print()
+    benchmark_connection_pool(args.pool_requests, args.pool_threads, 0)
+    print()
+    redis_db = get_redis(args.redis_url, args.fake_redis)
+    benchmark_persistence(redis_db, args.users, args.changed_users)
+    print()
+    benchmark_product_details(
+        redis_db,
+        args.product_views,
+        args.upstream_latency / 1000
+    )
+    print()
+    benchmark_follow_ups(redis_db, args.follow_ups, args.follow_up_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,16 @@
+import argparse
+import logging
 import os
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
 from functools import partial
 
 import redis
 import requests
 from dotenv import load_dotenv
-from geopy import distance
 from telegram import Update, LabeledPrice
+from telegram.error import BadRequest
+from telegram.utils.request import Request
 from telegram.ext import (Updater,
                           CommandHandler,
                           ConversationHandler,
@@ -14,25 +18,51 @@ from telegram.ext import (Updater,
                           PreCheckoutQueryHandler,
                           MessageHandler,
                           Filters,
-                          CallbackContext)
+                          CallbackContext,
+                          Defaults)
 from validate_email import validate_email
-from redispersistence.persistence import RedisPersistence
-
-
-from elastic_path_api import (fetch_cart,
-                              fetch_product,
-                              fetch_products,
-                              create_customer,
-                              get_product_image,
-                              add_product_to_cart,
-                              delete_product_from_cart,
-                              get_all_entries)
-from reply_markups_and_message_texts import (get_main_menu_reply_markup,
+
+from catalog_cache import (get_catalog,
+                           get_cached_product,
+                           get_products,
+                           refresh_products,
+                           get_cache_stats)
+from cart_mirror import (get_cart,
+                         get_mirrored_cart,
+                         reconcile_cart,
+                         add_cart_item,
+                         remove_cart_item)
+from elastic_path_api import (fetch_product,
+                              get_elastic_path_access_token,
+                              start_token_refresher)
+from follow_ups import schedule_follow_up, start_follow_up_worker
+from geocoder import get_coordinates
+from metrics import measure_conversation_handler, submit_in_context
+from order_dispatch import (DEFAULT_ORDER_WORKERS,
+                            enqueue_order,
+                            start_order_workers)
+from outbound_queue import DEFAULT_OUTBOUND_WORKERS, QueuedBot
+from pending_updates import handle_pending_updates
+from pizzeria_locator import find_nearest_pizzeria, load_pizzerias
+from product_images import (get_product_image,
+                            get_main_image_ids,
+                            warm_up_product_images)
+from redis_hash_persistence import RedisHashPersistence
+from reply_markups_and_message_texts import (MENU_PAGE_SIZE,
+                                             get_main_menu_reply_markup,
                                              get_cart_reply_markup,
                                              get_product_details_reply_markup,
                                              form_cart_message,
                                              form_product_details_message,
                                              form_delivery_message_and_reply_markup)
+from screen_renderer import render_screen
+from status_server import start_status_server
+from telegram_file_cache import (get_photo_file_id,
+                                 get_photo_file_ids,
+                                 save_photo_file_id,
+                                 delete_photo_file_id)
+from update_queue import run_update_worker
+from warm_up import start_warm_up
 
 
 class ConversationState(Enum):
@@ -44,12 +74,68 @@ class ConversationState(Enum):
     WAITING_LOCATION = 5
 
 
+UNAVAILABLE_MESSAGE = 'Магазин временно недоступен, попробуйте чуть позже'
+
+logger = logging.getLogger(__name__)
+
 _database = None
+_upstream_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('UPSTREAM_WORKERS', 16)),
+    thread_name_prefix='upstream'
+)
+
+
+def submit_upstream_call(function, *args):
+    # Independent upstream reads of one handler run at the same time.
+    # UPSTREAM_FANOUT=false runs them one after another, as before.
+    if os.getenv('UPSTREAM_FANOUT', 'true').lower() == 'true':
+        return submit_in_context(_upstream_executor, function, *args)
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as error:
+        future.set_exception(error)
+    return future
+
+
+def get_main_menu(page=1):
+    products, catalog_hash = get_catalog()
+    page_size = int(os.getenv('MENU_PAGE_SIZE', MENU_PAGE_SIZE))
+    group_by_category = \
+        os.getenv('MENU_GROUP_BY_CATEGORY', 'false').lower() == 'true'
+    return get_main_menu_reply_markup(
+        products,
+        page=page,
+        catalog_hash=catalog_hash,
+        page_size=page_size,
+        group_by_category=group_by_category
+    )
+
+
+def get_product_details(product_id):
+    try:
+        return fetch_product(product_id)
+    except requests.RequestException:
+        # The cached catalog has the same product data, maybe a bit older.
+        product = get_cached_product(product_id)
+        if product is None:
+            raise
+        return product
+
+
+def warm_up_product_photos(redis_db):
+    # Photos already uploaded to Telegram are sent by file_id, only the
+    # rest have to be downloaded and prepared before their first view.
+    image_ids = get_main_image_ids(get_products())
+    uploaded_image_ids = get_photo_file_ids(redis_db, image_ids)
+    warm_up_product_images(image_ids=[
+        image_id for image_id in image_ids
+        if image_id not in uploaded_image_ids
+    ])
 
 
 def start(update: Update, context: CallbackContext):
-    products = fetch_products()
-    reply_markup = get_main_menu_reply_markup(products)
+    reply_markup = get_main_menu()
     message_text = 'Добрый день! Пожалуйста, выберите пиццу:'
     update.message.reply_text(text=message_text, reply_markup=reply_markup)
     return ConversationState.HANDLE_MENU
@@ -59,36 +145,50 @@ def cancel(update, context, redis_db):
     return ConversationHandler.END
 
 
+def reload_menu(update: Update, context: CallbackContext):
+    products = refresh_products()
+    cache_stats = get_cache_stats()
+    stats_text = ', '.join(
+        f'{stat_name}: {stat_value}'
+        for stat_name, stat_value in cache_stats.items()
+    )
+    update.message.reply_text(
+        text=f'Меню обновлено, товаров: {len(products)}.\n{stats_text}'
+    )
+
+
 def change_main_menu_page(update: Update, context: CallbackContext):
     callback_data = update.callback_query.data
     if callback_data == 'page_inactive':
         update.callback_query.answer()
     else:
         page = int(callback_data.split('_')[1])
-        products = fetch_products()
-        reply_markup = get_main_menu_reply_markup(products, page=page)
-        update.callback_query.edit_message_reply_markup(reply_markup)
+        reply_markup = get_main_menu(page=page)
+        render_screen(
+            update.callback_query,
+            update.callback_query.message.text,
+            reply_markup
+        )
     return ConversationState.HANDLE_MENU
 
 
-def change_to_cart(update: Update, context: CallbackContext):
+def change_to_cart(update: Update, context: CallbackContext, redis_db):
     chat_id = update.callback_query.message.chat_id
-    cart = fetch_cart(chat_id)
+    cart = get_cart(chat_id, redis_db)
     cart_message = form_cart_message(cart)
     reply_markup = get_cart_reply_markup(cart)
-    update.callback_query.edit_message_text(cart_message)
-    update.callback_query.edit_message_reply_markup(reply_markup)
+    render_screen(update.callback_query, cart_message, reply_markup)
     return ConversationState.HANDLE_CART
 
 
-def send_product_details(update: Update, context: CallbackContext):
+def send_product_details(update: Update, context: CallbackContext, redis_db):
     chat_id = update.callback_query.message.chat_id
     product_id = update.callback_query.data
-    product_details = fetch_product(product_id)
+    cart_future = submit_upstream_call(get_cart, chat_id, redis_db)
+    product_details = get_product_details(product_id)
     product_image_id = (product_details['relationships']
                                        ['main_image']['data']['id'])
-    product_image = get_product_image(product_image_id)
-    cart = fetch_cart(chat_id)
+    cart = cart_future.result()
     cart_items = dict(
         (cart_item['product_id'], cart_item) for cart_item in cart['data']
     )
@@ -98,12 +198,32 @@ def send_product_details(update: Update, context: CallbackContext):
         product_in_cart
     )
     reply_markup = get_product_details_reply_markup(product_id)
-    with open(product_image, 'rb') as product_image:
-        context.bot.send_photo(
-            chat_id=chat_id,
-            photo=product_image,
-            caption=product_details_message,
-            reply_markup=reply_markup
+    photo_file_id = get_photo_file_id(redis_db, product_image_id)
+    if photo_file_id:
+        try:
+            context.bot.send_photo(
+                chat_id=chat_id,
+                photo=photo_file_id,
+                caption=product_details_message,
+                reply_markup=reply_markup
+            )
+        except BadRequest:
+            delete_photo_file_id(redis_db, product_image_id)
+            photo_file_id = None
+    if not photo_file_id:
+        product_image = get_product_image(product_image_id)
+        with open(product_image, 'rb') as product_image:
+            message = context.bot.send_photo(
+                chat_id=chat_id,
+                photo=product_image,
+                caption=product_details_message,
+                reply_markup=reply_markup
+            )
+        save_photo_file_id(
+            redis_db,
+            product_id,
+            product_image_id,
+            message.photo[-1].file_id
         )
     context.bot.delete_message(
         chat_id=chat_id,
@@ -114,25 +234,23 @@ def send_product_details(update: Update, context: CallbackContext):
 
 def change_to_main_menu(update: Update, context: CallbackContext):
     message_text = 'Добрый день! Пожалуйста, выберите пиццу:'
-    products = fetch_products()
-    reply_markup = get_main_menu_reply_markup(products)
-    update.callback_query.edit_message_text(message_text)
-    update.callback_query.edit_message_reply_markup(reply_markup)
+    reply_markup = get_main_menu()
+    render_screen(update.callback_query, message_text, reply_markup)
     return ConversationState.HANDLE_MENU
 
 
-def delete_from_cart(update: Update, context: CallbackContext):
+def delete_from_cart(update: Update, context: CallbackContext, redis_db):
     callback_data = update.callback_query.data
     chat_id = update.callback_query.message.chat_id
     product_to_delete_id = callback_data
-    cart = delete_product_from_cart(
+    cart = remove_cart_item(
         product_to_delete_id,
-        chat_id
+        chat_id,
+        redis_db
     )
     cart_message = form_cart_message(cart)
     reply_markup = get_cart_reply_markup(cart)
-    update.callback_query.edit_message_text(cart_message)
-    update.callback_query.edit_message_reply_markup(reply_markup)
+    render_screen(update.callback_query, cart_message, reply_markup)
     return ConversationState.HANDLE_CART
 
 
@@ -167,8 +285,7 @@ def send_contact_info_request(update: Update, context: CallbackContext):
 def send_main_menu(update: Update, context: CallbackContext):
     chat_id = update.callback_query.message.chat_id
     message_text = 'Добрый день! Пожалуйста, выберите пиццу:'
-    products = fetch_products()
-    reply_markup = get_main_menu_reply_markup(products)
+    reply_markup = get_main_menu()
     context.bot.send_message(
         chat_id=chat_id,
         text=message_text,
@@ -181,9 +298,9 @@ def send_main_menu(update: Update, context: CallbackContext):
     return ConversationState.HANDLE_MENU
 
 
-def send_cart(update: Update, context: CallbackContext):
+def send_cart(update: Update, context: CallbackContext, redis_db):
     chat_id = update.callback_query.message.chat_id
-    cart = fetch_cart(chat_id)
+    cart = get_cart(chat_id, redis_db)
     cart_message = form_cart_message(cart)
     reply_markup = get_cart_reply_markup(cart)
     context.bot.send_message(
@@ -198,13 +315,14 @@ def send_cart(update: Update, context: CallbackContext):
     return ConversationState.HANDLE_CART
 
 
-def add_product(update: Update, context: CallbackContext):
+def add_product(update: Update, context: CallbackContext, redis_db):
     chat_id = update.callback_query.message.chat_id
     product_id = update.callback_query.data
-    cart = add_product_to_cart(
+    cart = add_cart_item(
         product_id,
         1,
-        chat_id
+        chat_id,
+        redis_db
     )
     update.callback_query.answer(text='Пицца добавлена в корзину!')
     cart_items = dict(
@@ -263,17 +381,9 @@ def handle_location(update: Update, context: CallbackContext):
     context.user_data['latitude'] = location.latitude
     context.user_data['longitude'] = location.longitude
     customer_position = (location.latitude, location.longitude)
-    all_pizzerias = get_all_entries('pizzerias')
-    for pizzeria in all_pizzerias:
-        pizzeria['distance'] = distance.distance(
-            customer_position,
-            (pizzeria['lat'], pizzeria['lon'])
-        ).km
-    nearest_pizzeria = min(
-        all_pizzerias,
-        key=lambda pizzeria: pizzeria['distance']
-    )
-    context.user_data['pizzeria_for_order'] = nearest_pizzeria
+    nearest_pizzeria = find_nearest_pizzeria(customer_position)
+    context.user_data['pizzeria_id'] = nearest_pizzeria['id']
+    context.user_data['pizzeria_distance'] = nearest_pizzeria['distance']
     message_text, reply_markup = form_delivery_message_and_reply_markup(
         nearest_pizzeria['distance'],
         nearest_pizzeria['address']
@@ -286,38 +396,18 @@ def handle_location(update: Update, context: CallbackContext):
     return ConversationState.HANDLE_ORDER
 
 
-def handle_address(update: Update, context: CallbackContext, yandex_geocoder_key):
+def handle_address(update: Update, context: CallbackContext,
+                   yandex_geocoder_key, redis_db):
     chat_id = update.message.chat_id
-    base_url = "https://geocode-maps.yandex.ru/1.x"
     address = update.message.text
-    try:
-        response = requests.get(base_url, params={
-            "geocode": address,
-            "apikey": yandex_geocoder_key,
-            "format": "json",
-        })
-        response.raise_for_status()
-        found_places = (response.json()['response']['GeoObjectCollection']
-                                       ['featureMember'])
-    except requests.HTTPError:
-        found_places = None
-    if found_places:
-        most_relevant = found_places[0]
-        longitude, latitude = most_relevant['GeoObject']['Point']['pos'].split(" ")
-        context.user_data['latitude'] = float(latitude)
-        context.user_data['longitude'] = float(longitude)
-        customer_position = (latitude, longitude)
-        all_pizzerias = get_all_entries('pizzerias')
-        for pizzeria in all_pizzerias:
-            pizzeria['distance'] = distance.distance(
-                customer_position,
-                (pizzeria['lat'], pizzeria['lon'])
-            ).km
-        nearest_pizzeria = min(
-            all_pizzerias,
-            key=lambda pizzeria: pizzeria['distance']
-        )
-        context.user_data['pizzeria_for_order'] = nearest_pizzeria
+    coordinates = get_coordinates(yandex_geocoder_key, address, redis_db)
+    if coordinates:
+        latitude, longitude = coordinates
+        context.user_data['latitude'] = latitude
+        context.user_data['longitude'] = longitude
+        nearest_pizzeria = find_nearest_pizzeria(coordinates)
+        context.user_data['pizzeria_id'] = nearest_pizzeria['id']
+        context.user_data['pizzeria_distance'] = nearest_pizzeria['distance']
         message_text, reply_markup = form_delivery_message_and_reply_markup(
             nearest_pizzeria['distance'],
             nearest_pizzeria['address']
@@ -335,12 +425,13 @@ def handle_address(update: Update, context: CallbackContext, yandex_geocoder_key
     return ConversationState.WAITING_LOCATION
 
 
-def send_payment_invoice(update: Update, context: CallbackContext, provider_token):
+def send_payment_invoice(update: Update, context: CallbackContext,
+                         provider_token, redis_db):
     chat_id = update.callback_query.message.chat_id
     callback_data = update.callback_query.data
     delivery_type = callback_data.split('_')[1]
     context.user_data['delivery_type'] = delivery_type
-    user_cart = fetch_cart(chat_id)
+    user_cart = reconcile_cart(chat_id, redis_db)
     cart_total = user_cart['meta']['display_price']['with_tax']['amount']
     delivery_cost = {
         'pickup': 0,
@@ -368,59 +459,28 @@ def precheckout_callback(update: Update, context: CallbackContext):
         query.answer(ok=True)
 
 
-def follow_up_order(context: CallbackContext):
-    follow_up_message = 'Если вы до сих пор не получили вашу пиццу - ' \
-                        'свяжитесь с нами, и следующий заказ будет за' \
-                        'наш счет. Будем рады новым заказам!'
-    context.bot.send_message(
-        chat_id=context.job.context,
-        text=follow_up_message,
-    )
-
-
-def successful_order_callback(update: Update, context: CallbackContext):
+def successful_order_callback(update: Update, context: CallbackContext, redis_db):
     chat_id = update.message.chat_id
-    name = context.user_data.get('name')
-    email = context.user_data.get('email')
-    latitude = context.user_data.get('latitude')
-    longitude = context.user_data.get('longitude')
-    pizzeria = context.user_data.get('pizzeria_for_order')
-    delivery_type = context.user_data.get('delivery_type')
-    cart_items = fetch_cart(chat_id)['data']
-    delivery_chat_id = pizzeria['delivery_chat_id']
-    products_list_message = '\n'.join(
-        [f'{item["name"]}: {item["quantity"]} шт.' for item in cart_items]
-    )
-    if delivery_type == 'free':
-        delivery_message = f'{name} оставил новый заказ:\n\n' \
-                           f'{products_list_message}\n\n' \
-                           'Клиент заберет его самостоятельно.'
-        context.bot.send_message(
-            chat_id=delivery_chat_id,
-            text=delivery_message,
-        )
-    else:
-        delivery_message = f'{name} оставил новый заказ:\n\n' \
-                           f'{products_list_message}\n\n' \
-                           f'Адрес доставки находится в ' \
-                           f'{pizzeria["distance"]:.2f} км, вот здесь:'
-        context.bot.send_message(
-            chat_id=delivery_chat_id,
-            text=delivery_message,
-        )
-        context.bot.send_location(
-            chat_id=delivery_chat_id,
-            longitude=longitude,
-            latitude=latitude
-        )
-    customer = create_customer(name, email, latitude, longitude)
-    products = fetch_products()
-    reply_markup = get_main_menu_reply_markup(products)
+    # The cart mirrored when the invoice was sent is the one paid for,
+    # without it the worker fetches the cart itself.
+    cart = get_mirrored_cart(chat_id, max_age=None)
+    enqueue_order(redis_db, {
+        'chat_id': chat_id,
+        'name': context.user_data.get('name'),
+        'email': context.user_data.get('email'),
+        'latitude': context.user_data.get('latitude'),
+        'longitude': context.user_data.get('longitude'),
+        'pizzeria_id': context.user_data.get('pizzeria_id'),
+        'pizzeria_distance': context.user_data.get('pizzeria_distance'),
+        'delivery_type': context.user_data.get('delivery_type'),
+        'cart_items': cart['data'] if cart is not None else None,
+    })
+    reply_markup = get_main_menu()
     context.bot.send_message(
         chat_id=chat_id,
         text='Спасибо за заказ!'
     )
-    context.job_queue.run_once(follow_up_order, 3600, context=chat_id)
+    schedule_follow_up(redis_db, chat_id)
     context.bot.send_message(
         chat_id=chat_id,
         text='Добрый день! Пожалуйста, выберите пиццу:',
@@ -429,22 +489,30 @@ def successful_order_callback(update: Update, context: CallbackContext):
     return ConversationState.HANDLE_MENU
 
 
-def main():
-    load_dotenv()
-    tg_bot_token = os.getenv('TG_BOT_TOKEN')
-    redis_db_password = os.getenv('REDIS_DB_PASSWORD')
-    redis_db_port = int(os.getenv('REDIS_DB_PORT'))
-    redis_db_host = os.getenv('REDIS_DB_HOST')
-    yandex_geocoder_key = os.getenv('YANDEX_GEOCODER_KEY')
-    payment_provider_token = os.getenv('PAYMENT_PROVIDER_TOKEN')
-    redis_instance = redis.Redis(
-        host=redis_db_host,
-        port=redis_db_port,
-        password=redis_db_password
-    )
-    persistence = RedisPersistence(redis_instance)
-    updater = Updater(tg_bot_token, persistence=persistence)
-    dispatcher = updater.dispatcher
+def handle_error(update, context: CallbackContext):
+    if not isinstance(context.error, requests.RequestException):
+        logger.error(
+            'Update %s caused an error',
+            update,
+            exc_info=context.error
+        )
+        return
+    # Elastic Path is slow or down, tell the user right away instead of
+    # leaving the button spinning.
+    logger.warning('Upstream request failed: %s', context.error)
+    if not isinstance(update, Update):
+        return
+    if update.callback_query:
+        update.callback_query.answer(text=UNAVAILABLE_MESSAGE, show_alert=True)
+    elif update.effective_chat:
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=UNAVAILABLE_MESSAGE
+        )
+
+
+def add_handlers(dispatcher, redis_instance, yandex_geocoder_key,
+                 payment_provider_token, admin_chat_ids):
     # noinspection PyTypeChecker
     conversation_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -454,13 +522,23 @@ def main():
                     change_main_menu_page,
                     pattern='^(page_)\S\d*$'
                 ),
-                CallbackQueryHandler(change_to_cart, pattern='^(cart)$'),
-                CallbackQueryHandler(send_product_details),
+                CallbackQueryHandler(
+                    partial(change_to_cart, redis_db=redis_instance),
+                    pattern='^(cart)$'
+                ),
+                CallbackQueryHandler(
+                    partial(send_product_details, redis_db=redis_instance)
+                ),
             ],
             ConversationState.HANDLE_DESCRIPTION: [
                 CallbackQueryHandler(send_main_menu, pattern='^(main_menu)$'),
-                CallbackQueryHandler(send_cart, pattern='^(cart)$'),
-                CallbackQueryHandler(add_product),
+                CallbackQueryHandler(
+                    partial(send_cart, redis_db=redis_instance),
+                    pattern='^(cart)$'
+                ),
+                CallbackQueryHandler(
+                    partial(add_product, redis_db=redis_instance)
+                ),
             ],
             ConversationState.HANDLE_CART: [
                 CallbackQueryHandler(
@@ -471,20 +549,26 @@ def main():
                     send_contact_info_request,
                     pattern='^(order)$'
                 ),
-                CallbackQueryHandler(delete_from_cart),
+                CallbackQueryHandler(
+                    partial(delete_from_cart, redis_db=redis_instance)
+                ),
             ],
             ConversationState.HANDLE_ORDER: [
                 CallbackQueryHandler(send_main_menu, pattern='^(main_menu)$'),
                 CallbackQueryHandler(
                     partial(
                         send_payment_invoice,
-                        provider_token=payment_provider_token
+                        provider_token=payment_provider_token,
+                        redis_db=redis_instance
                     ),
                     pattern='^(delivery_)\S*$'
                 ),
                 MessageHandler(
                     Filters.successful_payment,
-                    successful_order_callback
+                    partial(
+                        successful_order_callback,
+                        redis_db=redis_instance
+                    )
                 ),
             ],
             ConversationState.WAITING_CONTACT_INFO: [
@@ -496,17 +580,111 @@ def main():
                     Filters.text,
                     partial(
                         handle_address,
-                        yandex_geocoder_key=yandex_geocoder_key
+                        yandex_geocoder_key=yandex_geocoder_key,
+                        redis_db=redis_instance
                     ),
                 ),
             ],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='pizza_order',
+        persistent=True
     )
+    dispatcher.add_handler(CommandHandler(
+        'reload_menu',
+        reload_menu,
+        filters=Filters.chat(chat_id=admin_chat_ids)
+    ))
+    measure_conversation_handler(conversation_handler)
+    handle_pending_updates(conversation_handler)
     dispatcher.add_handler(conversation_handler)
     dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    updater.start_polling()
-    updater.idle()
+    dispatcher.add_error_handler(handle_error)
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Pizza delivery bot')
+    parser.add_argument(
+        '--shard',
+        type=int,
+        help='handle updates of this shard from the webhook ingress queue '
+             'instead of polling Telegram'
+    )
+    args = parser.parse_args()
+    tg_bot_token = os.getenv('TG_BOT_TOKEN')
+    redis_db_password = os.getenv('REDIS_DB_PASSWORD')
+    redis_db_port = int(os.getenv('REDIS_DB_PORT'))
+    redis_db_host = os.getenv('REDIS_DB_HOST')
+    yandex_geocoder_key = os.getenv('YANDEX_GEOCODER_KEY')
+    payment_provider_token = os.getenv('PAYMENT_PROVIDER_TOKEN')
+    bot_workers = int(os.getenv('BOT_WORKERS', 32))
+    run_handlers_async = os.getenv('BOT_RUN_ASYNC', 'true').lower() == 'true'
+    if args.shard is not None:
+        # A shard worker handles its updates strictly one by one to keep
+        # every user's updates in order, throughput comes from more shards.
+        run_handlers_async = False
+    admin_chat_ids = [
+        int(chat_id) for chat_id
+        in os.getenv('TG_ADMIN_CHAT_IDS', '').split(',') if chat_id
+    ]
+    redis_instance = redis.Redis(
+        host=redis_db_host,
+        port=redis_db_port,
+        password=redis_db_password
+    )
+    share_elastic_path_token = \
+        os.getenv('ELASTIC_PATH_SHARED_TOKEN', 'false').lower() == 'true'
+    start_token_refresher(
+        redis_instance if share_elastic_path_token else None
+    )
+    # Without the token, the menu or the pizzerias the bot cannot take
+    # orders, missing photos are only prepared on first use.
+    start_warm_up(
+        [
+            ('token', get_elastic_path_access_token),
+            ('catalog', get_main_menu),
+            ('pizzerias', load_pizzerias),
+            ('images', warm_up_product_photos, redis_instance),
+        ],
+        required_phases=['token', 'catalog', 'pizzerias']
+    )
+    status_port = os.getenv('STATUS_PORT')
+    if status_port:
+        start_status_server(int(status_port))
+    persistence = RedisHashPersistence(redis_instance)
+    # Every message, edit and deletion waits its turn in the outbound
+    # queue to stay within Telegram flood limits.
+    queued_bot = QueuedBot(
+        tg_bot_token,
+        request=Request(con_pool_size=bot_workers + 4),
+        defaults=Defaults(run_async=run_handlers_async)
+    )
+    outbound_workers = int(
+        os.getenv('OUTBOUND_WORKERS', DEFAULT_OUTBOUND_WORKERS)
+    )
+    queued_bot.outbound_queue.start_workers(outbound_workers)
+    updater = Updater(
+        bot=queued_bot,
+        persistence=persistence,
+        workers=bot_workers
+    )
+    add_handlers(
+        updater.dispatcher,
+        redis_instance,
+        yandex_geocoder_key,
+        payment_provider_token,
+        admin_chat_ids
+    )
+    order_workers = int(os.getenv('ORDER_WORKERS', DEFAULT_ORDER_WORKERS))
+    start_order_workers(redis_instance, updater.bot, order_workers)
+    start_follow_up_worker(redis_instance, updater.bot)
+    if args.shard is not None:
+        run_update_worker(redis_instance, updater.dispatcher, args.shard)
+    else:
+        updater.start_polling()
+        updater.idle()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,166 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from circuit_breaker import CircuitOpenError
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# The server refused these before doing anything.
+CREATE_RETRY_STATUS_CODES = {429, 503}
+MAX_ATTEMPTS = 5
+BACKOFF_FACTOR = 1
+DEFAULT_RATE_LIMIT = 10
+
+
+class RateLimiter:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.results = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as checkpoint_file:
+                self.results = json.load(checkpoint_file)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.results
+
+    def get(self, key):
+        with self.lock:
+            return self.results.get(key)
+
+    def save(self, key, result):
+        with self.lock:
+            self.results[key] = result
+            if self.path is None:
+                return
+            temporary_path = f'{self.path}.tmp'
+            with open(temporary_path, 'w', encoding='utf-8') as checkpoint_file:
+                json.dump(self.results, checkpoint_file)
+            os.replace(temporary_path, self.path)
+
+
+def get_retry_delay(error, attempt):
+    response = getattr(error, 'response', None)
+    if response is not None and response.headers.get('Retry-After'):
+        try:
+            return float(response.headers['Retry-After'])
+        except ValueError:
+            pass
+    return BACKOFF_FACTOR * 2 ** attempt + random.uniform(0, BACKOFF_FACTOR)
+
+
+def is_connect_error(error):
+    # The request surely did not reach the server.
+    if isinstance(error, (requests.ConnectTimeout, CircuitOpenError)):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def is_retryable(error, idempotent=True):
+    if not idempotent:
+        # A create that timed out or got a 5xx may have been done already,
+        # repeating it would make a duplicate.
+        if isinstance(error, requests.HTTPError) and \
+                error.response is not None:
+            return error.response.status_code in CREATE_RETRY_STATUS_CODES
+        return isinstance(error, requests.ConnectionError) and \
+            is_connect_error(error)
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in RETRY_STATUS_CODES
+    return False
+
+
+def call_with_retries(rate_limiter, func, *args, idempotent=True):
+    for attempt in range(MAX_ATTEMPTS):
+        rate_limiter.acquire()
+        try:
+            return func(*args)
+        except requests.RequestException as error:
+            if not is_retryable(error, idempotent) or \
+                    attempt == MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(get_retry_delay(error, attempt))
+
+
+class BulkImporter:
+    def __init__(self, checkpoint_path, workers=8,
+                 rate_limit=DEFAULT_RATE_LIMIT):
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.workers = workers
+        self.rate_limit = rate_limit
+        self.rate_limiters = {}
+        self.rate_limiters_lock = threading.Lock()
+
+    def get_rate_limiter(self, endpoint):
+        with self.rate_limiters_lock:
+            if endpoint not in self.rate_limiters:
+                self.rate_limiters[endpoint] = RateLimiter(self.rate_limit)
+            return self.rate_limiters[endpoint]
+
+    def call(self, key, endpoint, func, *args, idempotent=True):
+        if key in self.checkpoint:
+            return self.checkpoint.get(key)
+        rate_limiter = self.get_rate_limiter(endpoint)
+        result = call_with_retries(
+            rate_limiter,
+            func,
+            *args,
+            idempotent=idempotent
+        )
+        self.checkpoint.save(key, result)
+        return result
+
+    def run(self, label, tasks):
+        tasks_count = len(tasks)
+        failed_tasks = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(task, *args): args
+                for task, *args in tasks
+            }
+            for done_count, future in enumerate(as_completed(futures), 1):
+                error = future.exception()
+                if error is not None:
+                    failed_tasks.append((futures[future], error))
+                print(
+                    f'{label}: {done_count}/{tasks_count} done, '
+                    f'{len(failed_tasks)} failed',
+                    flush=True
+                )
+        for args, error in failed_tasks:
+            print(f'{label} failed for {args}: {error!r}', flush=True)
+        return failed_tasks
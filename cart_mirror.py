@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from elastic_path_api import (fetch_cart,
+                              add_product_to_cart,
+                              delete_product_from_cart)
+from metrics import increment
+
+CONSISTENCY_WINDOW = 30
+LOCAL_CARTS_LIMIT = 10000
+
+LOCAL_CARTS = OrderedDict()
+CARTS_LOCK = threading.Lock()
+
+
+def store_cart(chat_id, cart, redis_db=None, updated_at=None):
+    if updated_at is None:
+        updated_at = time.time()
+    with CARTS_LOCK:
+        LOCAL_CARTS[chat_id] = (cart, updated_at)
+        LOCAL_CARTS.move_to_end(chat_id)
+        while len(LOCAL_CARTS) > LOCAL_CARTS_LIMIT:
+            LOCAL_CARTS.popitem(last=False)
+    if redis_db is not None:
+        mirrored_cart = json.dumps({'cart': cart, 'updated_at': updated_at})
+        redis_db.set(f'cart:{chat_id}', mirrored_cart, ex=CONSISTENCY_WINDOW)
+
+
+def get_mirrored_cart(chat_id, redis_db=None, max_age=CONSISTENCY_WINDOW):
+    with CARTS_LOCK:
+        mirrored_cart = LOCAL_CARTS.get(chat_id)
+    if mirrored_cart is None and redis_db is not None:
+        stored_cart = redis_db.get(f'cart:{chat_id}')
+        if stored_cart is not None:
+            stored_cart = json.loads(stored_cart)
+            mirrored_cart = (stored_cart['cart'], stored_cart['updated_at'])
+            with CARTS_LOCK:
+                LOCAL_CARTS[chat_id] = mirrored_cart
+    if mirrored_cart is None:
+        return None
+    cart, updated_at = mirrored_cart
+    if max_age is not None and time.time() - updated_at > max_age:
+        return None
+    return cart
+
+
+def get_cart(chat_id, redis_db=None):
+    cart = get_mirrored_cart(chat_id, redis_db)
+    if cart is not None:
+        increment('cart_reads_total', {'source': 'mirror'})
+        return cart
+    increment('cart_reads_total', {'source': 'elastic_path'})
+    try:
+        cart = fetch_cart(chat_id)
+    except requests.RequestException:
+        # An outdated cart is better than no answer while Elastic Path is
+        # unavailable.
+        cart = get_mirrored_cart(chat_id, max_age=None)
+        if cart is None:
+            raise
+        return cart
+    store_cart(chat_id, cart, redis_db)
+    return cart
+
+
+def reconcile_cart(chat_id, redis_db=None):
+    increment('cart_reads_total', {'source': 'elastic_path'})
+    increment('cart_reconciliations_total', {})
+    cart = fetch_cart(chat_id)
+    store_cart(chat_id, cart, redis_db)
+    return cart
+
+
+def add_cart_item(product_id, quantity, chat_id, redis_db=None):
+    cart = add_product_to_cart(product_id, quantity, chat_id)
+    store_cart(chat_id, cart, redis_db)
+    return cart
+
+
+def remove_cart_item(cart_item_id, chat_id, redis_db=None):
+    cart = delete_product_from_cart(cart_item_id, chat_id)
+    store_cart(chat_id, cart, redis_db)
+    return cart
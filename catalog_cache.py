@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from elastic_path_api import fetch_products
+
+DEFAULT_CATALOG_TTL = 300
+
+CATALOG = {
+    'products': None,
+    'hash': None,
+    'fetched_at': 0,
+    'refreshing': False,
+}
+CACHE_STATS = {
+    'hits': 0,
+    'stale_hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'refresh_errors': 0,
+}
+CATALOG_LOCK = threading.Lock()
+REFRESH_LOCK = threading.RLock()
+
+
+def get_catalog_ttl():
+    return float(os.getenv('CATALOG_TTL', DEFAULT_CATALOG_TTL))
+
+
+def get_catalog_hash(products):
+    serialized_products = json.dumps(products, sort_keys=True).encode()
+    return hashlib.sha256(serialized_products).hexdigest()
+
+
+def refresh_products():
+    with REFRESH_LOCK:
+        try:
+            products = fetch_products()
+        except Exception:
+            with CATALOG_LOCK:
+                CACHE_STATS['refresh_errors'] += 1
+            raise
+        finally:
+            with CATALOG_LOCK:
+                CATALOG['refreshing'] = False
+        catalog_hash = get_catalog_hash(products)
+        with CATALOG_LOCK:
+            CATALOG['products'] = products
+            CATALOG['hash'] = catalog_hash
+            CATALOG['fetched_at'] = time.monotonic()
+            CACHE_STATS['refreshes'] += 1
+    return products
+
+
+def refresh_products_in_background():
+    with CATALOG_LOCK:
+        if CATALOG['refreshing']:
+            return
+        CATALOG['refreshing'] = True
+    thread = threading.Thread(
+        target=_refresh_products_quietly,
+        name='catalog-refresh',
+        daemon=True
+    )
+    thread.start()
+
+
+def _refresh_products_quietly():
+    try:
+        refresh_products()
+    except Exception:
+        # The stale catalog keeps being served, next read retries refresh.
+        pass
+
+
+def get_catalog():
+    with CATALOG_LOCK:
+        products, catalog_hash = CATALOG['products'], CATALOG['hash']
+        if products is not None:
+            age = time.monotonic() - CATALOG['fetched_at']
+            if age < get_catalog_ttl():
+                CACHE_STATS['hits'] += 1
+                return products, catalog_hash
+            CACHE_STATS['stale_hits'] += 1
+        else:
+            CACHE_STATS['misses'] += 1
+    if products is not None:
+        refresh_products_in_background()
+        return products, catalog_hash
+    with REFRESH_LOCK:
+        with CATALOG_LOCK:
+            products, catalog_hash = CATALOG['products'], CATALOG['hash']
+        if products is None:
+            refresh_products()
+            with CATALOG_LOCK:
+                products, catalog_hash = CATALOG['products'], CATALOG['hash']
+    return products, catalog_hash
+
+
+def get_products():
+    products, _ = get_catalog()
+    return products
+
+
+def get_cached_product(product_id):
+    # Used when Elastic Path can not be reached, never fetches anything.
+    with CATALOG_LOCK:
+        products = CATALOG['products'] or []
+    for product in products:
+        if product['id'] == product_id:
+            return product
+    return None
+
+
+def get_cache_stats():
+    with CATALOG_LOCK:
+        return dict(CACHE_STATS)
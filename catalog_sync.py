@@ -0,0 +1,58 @@
+import hashlib
+import json
+
+
+def get_content_hash(fields):
+    serialized_fields = json.dumps(fields, sort_keys=True).encode()
+    return hashlib.sha256(serialized_fields).hexdigest()
+
+
+def get_product_fields(product_data, image_url):
+    return {
+        'name': product_data['name'],
+        'sku': product_data['sku'],
+        'description': product_data['description'],
+        'price': product_data['price'][0]['amount'],
+        'image_url': image_url,
+    }
+
+
+def get_main_image_url(product_data, file_urls):
+    # Files created from a file_location link to that location.
+    main_image = product_data.get('relationships', {}).get('main_image')
+    if not main_image:
+        return None
+    return file_urls.get(main_image['data']['id'])
+
+
+def get_changed_fields(desired_fields, upstream_fields):
+    return {
+        field_name for field_name, value in desired_fields.items()
+        if upstream_fields.get(field_name) != value
+    }
+
+
+def get_entry_fields(entry, field_names):
+    return {field_name: entry.get(field_name) for field_name in field_names}
+
+
+def plan_sync(desired_objects, upstream_objects):
+    # desired_objects maps a key (slug or alias) to fields, upstream_objects
+    # is a list of (key, id, fields). Upstream duplicates of one key left
+    # by earlier blind uploads are deleted, the first one is kept.
+    upstream_by_key = {}
+    ids_to_delete = []
+    for key, object_id, fields in upstream_objects:
+        if key in upstream_by_key or key not in desired_objects:
+            ids_to_delete.append(object_id)
+        else:
+            upstream_by_key[key] = (object_id, fields)
+    keys_to_create = [
+        key for key in desired_objects if key not in upstream_by_key
+    ]
+    objects_to_update = []
+    for key, (object_id, fields) in upstream_by_key.items():
+        desired_hash = get_content_hash(desired_objects[key])
+        if desired_hash != get_content_hash(fields):
+            objects_to_update.append((key, object_id))
+    return keys_to_create, objects_to_update, ids_to_delete
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import requests
+
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            waiting_for_reset = \
+                self.clock() - self.opened_at < self.reset_timeout
+            if waiting_for_reset or self.trial_running:
+                raise CircuitOpenError(f'{self.name} circuit is open')
+            # Half-open: a single request checks whether the upstream is
+            # back, the others keep failing fast until it finishes.
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or \
+                    self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None
+
+
+def get_circuit_breaker(name):
+    with BREAKERS_LOCK:
+        breaker = BREAKERS.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            BREAKERS[name] = breaker
+    return breaker
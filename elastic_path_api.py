@@ -1,75 +1,356 @@
+import json
+import logging
 import os
+import random
+import threading
 import time
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urljoin, urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from circuit_breaker import CircuitOpenError, get_circuit_breaker
+from metrics import increment, record_upstream_request, submit_in_context
+
+DEFAULT_API_URL = 'https://api.moltin.com'
+DEFAULT_POOL_SIZE = 32
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_TIMEOUT = 10
+GET_RETRIES = 2
+RETRY_BACKOFF = 0.2
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+MAX_RETRY_AFTER = 2
+# The largest page Elastic Path returns, the default one is only 25.
+PAGE_LIMIT = 100
+TOKEN_REFRESH_MARGIN = 60
+SHARED_TOKEN_KEY = 'elastic_path:access_token'
+
+logger = logging.getLogger(__name__)
 
 ACCESS_TOKEN = None
 EXPIRATION_TIME = None
-
-
-def get_elastic_path_access_token():
+TOKEN_LOCK = threading.Lock()
+TOKEN_STORAGE = {
+    'redis_db': None,
+    'refresh_timer': None,
+}
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+
+def get_elastic_path_session():
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            pool_size = int(
+                os.getenv('ELASTIC_PATH_POOL_SIZE', DEFAULT_POOL_SIZE)
+            )
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            SESSION = session
+    return SESSION
+
+
+def is_pooling_enabled():
+    return os.getenv('ELASTIC_PATH_POOLING', 'true').lower() == 'true'
+
+
+def get_api_url(path):
+    api_url = os.getenv('ELASTIC_PATH_API_URL', DEFAULT_API_URL)
+    return f'{api_url}{path}'
+
+
+def get_endpoint_family(url):
+    # /v2/carts/{id}/items -> carts, file downloads go to another host.
+    api_host = urlsplit(get_api_url('')).netloc
+    split_url = urlsplit(url)
+    if split_url.netloc != api_host:
+        return 'downloads'
+    path_parts = [part for part in split_url.path.split('/') if part]
+    if path_parts and path_parts[0] == 'v2':
+        path_parts = path_parts[1:]
+    return path_parts[0] if path_parts else 'root'
+
+
+def is_upstream_failure(status_code):
+    # 4xx answers mean the upstream is alive, only 5xx open the circuit.
+    # 429 is the rate limit: a burst from the upload script must not cut
+    # the bot off, it waits for Retry-After instead.
+    return status_code >= 500
+
+
+def get_retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
+
+
+def send_request(method, url, endpoint_family, **kwargs):
+    breaker = get_circuit_breaker(f'elastic_path:{endpoint_family}')
+    try:
+        breaker.before_request()
+    except CircuitOpenError:
+        increment(
+            'upstream_circuit_open_total',
+            {'upstream': 'elastic_path', 'endpoint': endpoint_family}
+        )
+        raise
+    if is_pooling_enabled():
+        request = get_elastic_path_session().request
+    else:
+        # A new connection for every request, to measure what the pool saves.
+        request = requests.request
+    started_at = time.perf_counter()
+    failed = True
+    upstream_failed = True
+    try:
+        response = request(method, url, **kwargs)
+        failed = response.status_code >= 400
+        upstream_failed = is_upstream_failure(response.status_code)
+        return response
+    finally:
+        record_upstream_request(
+            'elastic_path',
+            endpoint_family,
+            method,
+            time.perf_counter() - started_at,
+            failed
+        )
+        if upstream_failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+
+def make_request(method, url, **kwargs):
+    connect_timeout = float(
+        os.getenv('ELASTIC_PATH_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)
+    )
+    read_timeout = float(os.getenv('ELASTIC_PATH_TIMEOUT', DEFAULT_TIMEOUT))
+    kwargs.setdefault('timeout', (connect_timeout, read_timeout))
+    endpoint_family = get_endpoint_family(url)
+    attempts_count = 1 + GET_RETRIES if method == 'GET' else 1
+    for attempt in range(attempts_count):
+        is_last_attempt = attempt == attempts_count - 1
+        try:
+            response = send_request(method, url, endpoint_family, **kwargs)
+        except CircuitOpenError:
+            raise
+        except requests.ConnectionError:
+            # Read timeouts are not retried, waiting for a slow upstream
+            # several times over would only hold the handler longer.
+            if is_last_attempt:
+                raise
+        else:
+            if is_last_attempt or \
+                    response.status_code not in RETRY_STATUS_CODES:
+                return response
+            retry_after = get_retry_after(response)
+            if retry_after is not None:
+                # Waiting longer would only hold the handler.
+                if retry_after > MAX_RETRY_AFTER:
+                    return response
+                time.sleep(retry_after)
+                continue
+        time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+
+
+def request_access_token():
+    client_id = os.getenv('ELASTIC_PATH_CLIENT_ID')
+    client_secret = os.getenv('ELASTIC_PATH_CLIENT_SECRET')
+    url = get_api_url('/oauth/access_token')
+    data = {
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'grant_type': 'client_credentials'
+    }
+    response = make_request('POST', url, data=data)
+    response.raise_for_status()
+    decoded_response = response.json()
+    return decoded_response['access_token'], decoded_response['expires']
+
+
+def token_is_fresh(expiration_time, margin=TOKEN_REFRESH_MARGIN):
+    return expiration_time is not None and \
+        expiration_time - margin > time.time()
+
+
+def get_shared_access_token(redis_db, margin):
+    # Several bot processes share one token, the Redis lock makes only
+    # one of them ask Elastic Path for a new one.
+    with redis_db.lock(f'{SHARED_TOKEN_KEY}:lock', timeout=30,
+                       blocking_timeout=30):
+        shared_token = redis_db.get(SHARED_TOKEN_KEY)
+        if shared_token is not None:
+            access_token, expiration_time = json.loads(shared_token)
+            if token_is_fresh(expiration_time, margin):
+                return access_token, expiration_time
+        access_token, expiration_time = request_access_token()
+        redis_db.set(
+            SHARED_TOKEN_KEY,
+            json.dumps([access_token, expiration_time]),
+            ex=max(int(expiration_time - time.time()), 1)
+        )
+    return access_token, expiration_time
+
+
+def refresh_access_token(margin=TOKEN_REFRESH_MARGIN):
+    # Must be called with TOKEN_LOCK held.
     global ACCESS_TOKEN
     global EXPIRATION_TIME
-    current_time = time.time()
-    if ACCESS_TOKEN is None or EXPIRATION_TIME - 60 < current_time:
-        client_id = os.getenv('ELASTIC_PATH_CLIENT_ID')
-        client_secret = os.getenv('ELASTIC_PATH_CLIENT_SECRET')
-        url = 'https://api.moltin.com/oauth/access_token'
-        data = {
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'grant_type': 'client_credentials'
-        }
-        response = requests.post(url, data=data)
-        response.raise_for_status()
-        decoded_response = response.json()
-        ACCESS_TOKEN = decoded_response['access_token']
-        EXPIRATION_TIME = decoded_response['expires']
-    return ACCESS_TOKEN
+    redis_db = TOKEN_STORAGE['redis_db']
+    if redis_db is None:
+        access_token, expiration_time = request_access_token()
+    else:
+        access_token, expiration_time = get_shared_access_token(
+            redis_db,
+            margin
+        )
+    ACCESS_TOKEN = access_token
+    EXPIRATION_TIME = expiration_time
 
 
-def fetch_products():
+def get_elastic_path_access_token():
+    if token_is_fresh(EXPIRATION_TIME):
+        return ACCESS_TOKEN
+    with TOKEN_LOCK:
+        if not token_is_fresh(EXPIRATION_TIME):
+            refresh_access_token()
+        return ACCESS_TOKEN
+
+
+def schedule_token_refresh():
+    if EXPIRATION_TIME is None:
+        delay = TOKEN_REFRESH_MARGIN
+    else:
+        refresh_time = EXPIRATION_TIME - 2 * TOKEN_REFRESH_MARGIN
+        delay = max(refresh_time - time.time(), 5)
+    refresh_timer = threading.Timer(delay, refresh_token_in_background)
+    refresh_timer.daemon = True
+    TOKEN_STORAGE['refresh_timer'] = refresh_timer
+    refresh_timer.start()
+
+
+def refresh_token_in_background():
+    try:
+        with TOKEN_LOCK:
+            # The first timer fires before the token that the warm-up or
+            # an API call got is anywhere near its expiration.
+            if not token_is_fresh(EXPIRATION_TIME, 2 * TOKEN_REFRESH_MARGIN):
+                refresh_access_token(margin=2 * TOKEN_REFRESH_MARGIN)
+    except Exception:
+        logger.exception('Elastic Path access token refresh failed')
+    schedule_token_refresh()
+
+
+def start_token_refresher(redis_db=None):
+    # The first token is requested by the startup warm-up or by the first
+    # API call, whichever comes first.
+    TOKEN_STORAGE['redis_db'] = redis_db
+    schedule_token_refresh()
+
+
+def fetch_page(url, params=None):
     access_token = get_elastic_path_access_token()
-    url = 'https://api.moltin.com/v2/products'
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(url, headers=headers)
+    response = make_request('GET', url, headers=headers, params=params)
     response.raise_for_status()
-    products = response.json()['data']
-    return products
+    return response.json()
+
+
+def get_page_key(url, params=None):
+    # The first page is asked for with params and may leave the offset
+    # out, the links to later pages carry all of it in the query.
+    split_url = urlsplit(url)
+    query = parse_qs(split_url.query)
+    for name, value in (params or {}).items():
+        query[name] = [str(value)]
+    query.setdefault('page[offset]', ['0'])
+    return split_url.netloc, split_url.path, sorted(query.items())
+
+
+def iterate_objects(path, page_limit=PAGE_LIMIT):
+    # Follows links.next and fetches the next page while the current one
+    # is consumed, so at most two pages are held in memory.
+    page_url = get_api_url(path)
+    params = {'page[limit]': page_limit}
+    page_key = get_page_key(page_url, params)
+    page = fetch_page(page_url, params)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            next_page_url = (page.get('links') or {}).get('next')
+            if next_page_url:
+                next_page_url = urljoin(page_url, next_page_url)
+            # The last page has no next link or links to itself.
+            if not page['data'] or not next_page_url or \
+                    get_page_key(next_page_url) == page_key:
+                next_page_future = None
+            else:
+                next_page_future = submit_in_context(
+                    executor,
+                    fetch_page,
+                    next_page_url
+                )
+            yield from page['data']
+            if next_page_future is None:
+                return
+            page_url = next_page_url
+            page_key = get_page_key(page_url)
+            page = next_page_future.result()
+
+
+def fetch_products():
+    return list(iterate_objects('/v2/products'))
+
+
+def fetch_files():
+    return list(iterate_objects('/v2/files'))
+
+
+def find_product_by_slug(slug):
+    page = fetch_page(
+        get_api_url('/v2/products'),
+        {'filter': f'eq(slug,{slug})'}
+    )
+    return page['data'][0]['id'] if page['data'] else None
 
 
 def fetch_product(product_id):
     access_token = get_elastic_path_access_token()
-    url = f'https://api.moltin.com/v2/products/{product_id}'
+    url = get_api_url(f'/v2/products/{product_id}')
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(url, headers=headers)
+    response = make_request('GET', url, headers=headers)
     response.raise_for_status()
     product = response.json()['data']
     return product
 
 
-def get_product_image(file_id):
+def fetch_file(file_id):
     access_token = get_elastic_path_access_token()
-    url = f'https://api.moltin.com/v2/files/{file_id}'
+    url = get_api_url(f'/v2/files/{file_id}')
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(url, headers=headers)
+    response = make_request('GET', url, headers=headers)
     response.raise_for_status()
-    image_metadata = response.json()['data']
-    image_directory = Path('./images')
-    Path.mkdir(image_directory, exist_ok=True)
-    image_path = Path(image_directory, image_metadata['id']+'.jpg')
-    if not image_path.exists():
-        response = requests.get(image_metadata['link']['href'])
-        response.raise_for_status()
-        with open(image_path, 'wb') as file:
-            file.write(response.content)
-    return image_path
+    file_metadata = response.json()['data']
+    return file_metadata
+
+
+def download_file(file_url):
+    response = make_request('GET', file_url)
+    response.raise_for_status()
+    return response.content
 
 
 def add_product_to_cart(product_id, quantity, cart_id):
     access_token = get_elastic_path_access_token()
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items'
+    url = get_api_url(f'/v2/carts/{cart_id}/items')
     headers = {'Authorization': f'Bearer {access_token}'}
     payload = {
         'data': {
@@ -78,7 +359,7 @@ def add_product_to_cart(product_id, quantity, cart_id):
             'quantity': quantity
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = make_request('POST', url, headers=headers, json=payload)
     response.raise_for_status()
     cart = response.json()
     return cart
@@ -86,9 +367,9 @@ def add_product_to_cart(product_id, quantity, cart_id):
 
 def delete_product_from_cart(product_id, cart_id):
     access_token = get_elastic_path_access_token()
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items/{product_id}'
+    url = get_api_url(f'/v2/carts/{cart_id}/items/{product_id}')
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.delete(url, headers=headers)
+    response = make_request('DELETE', url, headers=headers)
     response.raise_for_status()
     cart = response.json()
     return cart
@@ -96,9 +377,9 @@ def delete_product_from_cart(product_id, cart_id):
 
 def fetch_cart(cart_id):
     access_token = get_elastic_path_access_token()
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items'
+    url = get_api_url(f'/v2/carts/{cart_id}/items')
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(url, headers=headers)
+    response = make_request('GET', url, headers=headers)
     response.raise_for_status()
     cart = response.json()
     return cart
@@ -106,7 +387,7 @@ def fetch_cart(cart_id):
 
 def create_customer(customer_name, customer_email, latitude, longitude):
     access_token = get_elastic_path_access_token()
-    url = 'https://api.moltin.com/v2/customers'
+    url = get_api_url('/v2/customers')
     headers = {'Authorization': f'Bearer {access_token}'}
     payload = {
         'data': {
@@ -117,16 +398,13 @@ def create_customer(customer_name, customer_email, latitude, longitude):
             'lon': longitude
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = make_request('POST', url, headers=headers, json=payload)
     response.raise_for_status()
     customer = response.json()['data']
     return customer
 
 
-def create_product(product):
-    access_token = get_elastic_path_access_token()
-    url = 'https://api.moltin.com/v2/products'
-    headers = {'Authorization': f'Bearer {access_token}'}
+def get_product_payload(product):
     payload = {
         'data': {
             'type': 'product',
@@ -146,20 +424,48 @@ def create_product(product):
             ]
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
+    return payload
+
+
+def create_product(product):
+    access_token = get_elastic_path_access_token()
+    url = get_api_url('/v2/products')
+    headers = {'Authorization': f'Bearer {access_token}'}
+    payload = get_product_payload(product)
+    response = make_request('POST', url, headers=headers, json=payload)
     response.raise_for_status()
     created_product = response.json()['data']
     return created_product['id']
 
 
+def update_product(product_id, product):
+    access_token = get_elastic_path_access_token()
+    url = get_api_url(f'/v2/products/{product_id}')
+    headers = {'Authorization': f'Bearer {access_token}'}
+    payload = get_product_payload(product)
+    payload['data']['id'] = product_id
+    response = make_request('PUT', url, headers=headers, json=payload)
+    response.raise_for_status()
+    updated_product = response.json()['data']
+    return updated_product['id']
+
+
+def delete_product(product_id):
+    access_token = get_elastic_path_access_token()
+    url = get_api_url(f'/v2/products/{product_id}')
+    headers = {'Authorization': f'Bearer {access_token}'}
+    response = make_request('DELETE', url, headers=headers)
+    response.raise_for_status()
+
+
 def create_image(image_url):
     access_token = get_elastic_path_access_token()
-    url = 'https://api.moltin.com/v2/files'
+    url = get_api_url('/v2/files')
     headers = {'Authorization': f'Bearer {access_token}'}
     files = {
         'file_location': (None, image_url),
     }
-    response = requests.post(url, headers=headers, files=files)
+    response = make_request('POST', url, headers=headers, files=files)
     response.raise_for_status()
     created_file = response.json()['data']
     return created_file['id']
@@ -167,7 +473,7 @@ def create_image(image_url):
 
 def set_product_main_image(product_id, image_id):
     access_token = get_elastic_path_access_token()
-    url = f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image'
+    url = get_api_url(f'/v2/products/{product_id}/relationships/main-image')
     headers = {'Authorization': f'Bearer {access_token}'}
     payload = {
         'data': {
@@ -175,13 +481,13 @@ def set_product_main_image(product_id, image_id):
             'type': 'main_image'
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = make_request('POST', url, headers=headers, json=payload)
     response.raise_for_status()
 
 
 def create_flow(flow_name, flow_description):
     access_token = get_elastic_path_access_token()
-    url = 'https://api.moltin.com/v2/flows'
+    url = get_api_url('/v2/flows')
     headers = {'Authorization': f'Bearer {access_token}'}
     payload = {
         'data': {
@@ -192,15 +498,25 @@ def create_flow(flow_name, flow_description):
             'enabled': True
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = make_request('POST', url, headers=headers, json=payload)
     response.raise_for_status()
     created_flow = response.json()['data']
     return created_flow['id']
 
 
+def fetch_flows():
+    access_token = get_elastic_path_access_token()
+    url = get_api_url('/v2/flows')
+    headers = {'Authorization': f'Bearer {access_token}'}
+    response = make_request('GET', url, headers=headers)
+    response.raise_for_status()
+    flows = response.json()['data']
+    return flows
+
+
 def create_flow_field(flow_id, field: dict):
     access_token = get_elastic_path_access_token()
-    url = 'https://api.moltin.com/v2/fields'
+    url = get_api_url('/v2/fields')
     headers = {'Authorization': f'Bearer {access_token}'}
     payload = {
         'data': {
@@ -221,7 +537,7 @@ def create_flow_field(flow_id, field: dict):
             }
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = make_request('POST', url, headers=headers, json=payload)
     response.raise_for_status()
     created_field = response.json()['data']
     return created_field['id']
@@ -229,7 +545,7 @@ def create_flow_field(flow_id, field: dict):
 
 def create_flow_entry(flow_slug, field_values):
     access_token = get_elastic_path_access_token()
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
+    url = get_api_url(f'/v2/flows/{flow_slug}/entries')
     headers = {'Authorization': f'Bearer {access_token}'}
     payload = {
         'data': {
@@ -238,27 +554,51 @@ def create_flow_entry(flow_slug, field_values):
     }
     for field_name, field_value in field_values.items():
         payload['data'][field_name] = field_value
-    response = requests.post(url, headers=headers, json=payload)
+    response = make_request('POST', url, headers=headers, json=payload)
     response.raise_for_status()
     created_flow_entry = response.json()['data']
     return created_flow_entry['id']
 
 
-def get_all_entries(flow_slug):
+def update_flow_entry(flow_slug, entry_id, field_values):
     access_token = get_elastic_path_access_token()
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
+    url = get_api_url(f'/v2/flows/{flow_slug}/entries/{entry_id}')
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(url, headers=headers)
+    payload = {
+        'data': {
+            'type': 'entry',
+            'id': entry_id
+        }
+    }
+    for field_name, field_value in field_values.items():
+        payload['data'][field_name] = field_value
+    response = make_request('PUT', url, headers=headers, json=payload)
+    response.raise_for_status()
+    updated_flow_entry = response.json()['data']
+    return updated_flow_entry['id']
+
+
+def delete_flow_entry(flow_slug, entry_id):
+    access_token = get_elastic_path_access_token()
+    url = get_api_url(f'/v2/flows/{flow_slug}/entries/{entry_id}')
+    headers = {'Authorization': f'Bearer {access_token}'}
+    response = make_request('DELETE', url, headers=headers)
     response.raise_for_status()
-    entries = response.json()['data']
-    return entries
+
+
+def iterate_entries(flow_slug, page_limit=PAGE_LIMIT):
+    return iterate_objects(f'/v2/flows/{flow_slug}/entries', page_limit)
+
+
+def get_all_entries(flow_slug):
+    return list(iterate_entries(flow_slug))
 
 
 def get_entry(flow_slug, entry_id):
     access_token = get_elastic_path_access_token()
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}'
+    url = get_api_url(f'/v2/flows/{flow_slug}/entries/{entry_id}')
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(url, headers=headers)
+    response = make_request('GET', url, headers=headers)
     response.raise_for_status()
     entry = response.json()['data']
     return entry
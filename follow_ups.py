@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+import uuid
+
+from telegram.error import BadRequest, RetryAfter, TelegramError, Unauthorized
+
+from outbound_queue import PRIORITY_BACKGROUND, SEND_PRIORITY
+
+FOLLOW_UPS_KEY = 'follow_ups'
+FOLLOW_UP_DELAY = 3600
+FOLLOW_UP_MESSAGE = 'Если вы до сих пор не получили вашу пиццу - ' \
+                    'свяжитесь с нами, и следующий заказ будет за' \
+                    'наш счет. Будем рады новым заказам!'
+BATCH_SIZE = 100
+CLAIM_TIMEOUT = 60
+POLL_INTERVAL = 1
+# Telegram allows about 30 messages per second to different chats,
+# the rest is left for the conversation itself.
+SEND_RATE = 20
+
+# Claiming moves due follow-ups forward by CLAIM_TIMEOUT in the same
+# sorted set. A worker that sent one removes it, if the worker dies the
+# follow-up gets due again and another worker sends it.
+CLAIM_DUE_FOLLOW_UPS_SCRIPT = '''
+local follow_ups = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                              'LIMIT', 0, ARGV[2])
+for _, follow_up in ipairs(follow_ups) do
+    redis.call('ZADD', KEYS[1], ARGV[1] + ARGV[3], follow_up)
+end
+return follow_ups
+'''
+
+logger = logging.getLogger(__name__)
+
+
+def schedule_follow_up(redis_db, chat_id, delay=FOLLOW_UP_DELAY,
+                       clock=time.time):
+    follow_up = f'{uuid.uuid4().hex}:{chat_id}'
+    redis_db.zadd(FOLLOW_UPS_KEY, {follow_up: clock() + delay})
+    return follow_up
+
+
+def get_follow_up_chat_id(follow_up):
+    if isinstance(follow_up, bytes):
+        follow_up = follow_up.decode()
+    return int(follow_up.split(':', 1)[1])
+
+
+def wait_for_send_slot(redis_db, clock, sleep):
+    # One counter per second shared by all bot processes.
+    while True:
+        now = clock()
+        second = int(now)
+        rate_key = f'{FOLLOW_UPS_KEY}:sent:{second}'
+        pipeline = redis_db.pipeline()
+        pipeline.incr(rate_key)
+        pipeline.expire(rate_key, 2)
+        sent_count, _ = pipeline.execute()
+        if sent_count <= SEND_RATE:
+            return
+        sleep(second + 1 - now)
+
+
+def postpone_follow_ups(redis_db, follow_ups, due_at):
+    redis_db.zadd(
+        FOLLOW_UPS_KEY,
+        {follow_up: due_at for follow_up in follow_ups}
+    )
+
+
+def send_follow_up(bot, redis_db, follow_up):
+    try:
+        bot.send_message(
+            chat_id=get_follow_up_chat_id(follow_up),
+            text=FOLLOW_UP_MESSAGE,
+        )
+    except (BadRequest, Unauthorized):
+        # The chat is gone or the user blocked the bot, no point to retry.
+        logger.warning('Follow-up %s dropped', follow_up, exc_info=True)
+    redis_db.zrem(FOLLOW_UPS_KEY, follow_up)
+
+
+def send_due_follow_ups(redis_db, bot, claim_due_follow_ups,
+                        clock=time.time, sleep=time.sleep):
+    follow_ups = claim_due_follow_ups(
+        keys=[FOLLOW_UPS_KEY],
+        args=[clock(), BATCH_SIZE, CLAIM_TIMEOUT]
+    )
+    for position, follow_up in enumerate(follow_ups):
+        wait_for_send_slot(redis_db, clock, sleep)
+        try:
+            send_follow_up(bot, redis_db, follow_up)
+        except RetryAfter as error:
+            # Telegram asked to slow down, the rest of the batch waits too.
+            postpone_follow_ups(
+                redis_db,
+                follow_ups[position:],
+                clock() + error.retry_after
+            )
+            sleep(error.retry_after)
+            return position
+        except TelegramError:
+            # Left claimed, it is sent again after CLAIM_TIMEOUT.
+            logger.exception('Follow-up %s failed', follow_up)
+    return len(follow_ups)
+
+
+def run_follow_up_worker(redis_db, bot, clock=time.time, sleep=time.sleep):
+    SEND_PRIORITY.set(PRIORITY_BACKGROUND)
+    claim_due_follow_ups = redis_db.register_script(
+        CLAIM_DUE_FOLLOW_UPS_SCRIPT
+    )
+    while True:
+        try:
+            sent_count = send_due_follow_ups(
+                redis_db,
+                bot,
+                claim_due_follow_ups,
+                clock,
+                sleep
+            )
+        except Exception:
+            logger.exception('Follow-up worker failed, retrying')
+            sent_count = 0
+        if sent_count < BATCH_SIZE:
+            sleep(POLL_INTERVAL)
+
+
+def start_follow_up_worker(redis_db, bot):
+    thread = threading.Thread(
+        target=run_follow_up_worker,
+        args=(redis_db, bot),
+        name='follow-up-worker',
+        daemon=True
+    )
+    thread.start()
+    return thread
@@ -0,0 +1,35 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Haversine treats the Earth as a sphere of the mean radius. Against the
+# WGS-84 geodesic used by geopy the error stays below 0.6 %, which is
+# 3 m at the 0.5 km delivery band edge and 120 m at the 20 km one.
+RELATIVE_TOLERANCE = 0.006
+
+
+def to_radians_array(positions):
+    positions = np.asarray(positions, dtype=np.float64)
+    return np.radians(positions.reshape(-1, 2))
+
+
+def pairwise_haversine_distances(origins, destinations):
+    origins = to_radians_array(origins)
+    destinations = to_radians_array(destinations)
+    origin_lat = origins[:, 0, np.newaxis]
+    origin_lon = origins[:, 1, np.newaxis]
+    destination_lat = destinations[np.newaxis, :, 0]
+    destination_lon = destinations[np.newaxis, :, 1]
+    lat_delta = destination_lat - origin_lat
+    lon_delta = destination_lon - origin_lon
+    half_chord = (
+        np.sin(lat_delta / 2) ** 2
+        + np.cos(origin_lat) * np.cos(destination_lat)
+        * np.sin(lon_delta / 2) ** 2
+    )
+    central_angle = 2 * np.arcsin(np.sqrt(np.clip(half_chord, 0, 1)))
+    return EARTH_RADIUS_KM * central_angle
+
+
+def haversine_distances(origin, destinations):
+    return pairwise_haversine_distances(origin, destinations)[0]
@@ -0,0 +1,119 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from circuit_breaker import get_circuit_breaker
+from metrics import record_upstream_request
+
+DEFAULT_GEOCODER_URL = 'https://geocode-maps.yandex.ru/1.x'
+# Connect and read timeouts.
+GEOCODER_TIMEOUT = (3.05, 5)
+LOCAL_CACHE_SIZE = 10000
+FOUND_TTL = 30 * 24 * 60 * 60
+NOT_FOUND_TTL = 24 * 60 * 60
+
+LOCAL_CACHE = OrderedDict()
+LOCAL_CACHE_LOCK = threading.Lock()
+
+
+def normalize_address(address):
+    address = address.lower().replace('ё', 'е')
+    return ' '.join(re.findall(r'\w+', address))
+
+
+def fetch_coordinates(apikey, address):
+    base_url = os.getenv('YANDEX_GEOCODER_URL', DEFAULT_GEOCODER_URL)
+    breaker = get_circuit_breaker('yandex_geocoder')
+    breaker.before_request()
+    started_at = time.perf_counter()
+    failed = True
+    upstream_failed = True
+    try:
+        response = requests.get(base_url, params={
+            'geocode': address,
+            'apikey': apikey,
+            'format': 'json',
+        }, timeout=GEOCODER_TIMEOUT)
+        failed = not response.ok
+        upstream_failed = response.status_code >= 500
+    finally:
+        record_upstream_request(
+            'yandex_geocoder',
+            'geocode',
+            'GET',
+            time.perf_counter() - started_at,
+            failed
+        )
+        if upstream_failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    response.raise_for_status()
+    found_places = (response.json()['response']['GeoObjectCollection']
+                                   ['featureMember'])
+    if not found_places:
+        return None
+    most_relevant = found_places[0]
+    longitude, latitude = most_relevant['GeoObject']['Point']['pos'].split(' ')
+    return float(latitude), float(longitude)
+
+
+def get_local_cache(cache_key):
+    with LOCAL_CACHE_LOCK:
+        cached = LOCAL_CACHE.get(cache_key)
+        if cached is None:
+            return None
+        coordinates, expires_at = cached
+        if expires_at < time.monotonic():
+            del LOCAL_CACHE[cache_key]
+            return None
+        LOCAL_CACHE.move_to_end(cache_key)
+        return cached
+
+
+def set_local_cache(cache_key, coordinates, ttl):
+    with LOCAL_CACHE_LOCK:
+        LOCAL_CACHE[cache_key] = (coordinates, time.monotonic() + ttl)
+        LOCAL_CACHE.move_to_end(cache_key)
+        while len(LOCAL_CACHE) > LOCAL_CACHE_SIZE:
+            LOCAL_CACHE.popitem(last=False)
+
+
+def get_coordinates(apikey, address, redis_db=None,
+                    fetch=fetch_coordinates):
+    normalized_address = normalize_address(address)
+    if not normalized_address:
+        return None
+    cache_key = f'geocode:{normalized_address}'
+    cached = get_local_cache(cache_key)
+    if cached is not None:
+        coordinates, _ = cached
+        return coordinates
+    if redis_db is not None:
+        cached_coordinates = redis_db.get(cache_key)
+        if cached_coordinates is not None:
+            coordinates = json.loads(cached_coordinates)
+            if coordinates is not None:
+                coordinates = tuple(coordinates)
+            ttl = redis_db.ttl(cache_key)
+            set_local_cache(
+                cache_key,
+                coordinates,
+                ttl if ttl > 0 else NOT_FOUND_TTL
+            )
+            return coordinates
+    try:
+        coordinates = fetch(apikey, address)
+    except (requests.RequestException, KeyError, ValueError):
+        # Upstream failures are not cached, the next attempt asks again.
+        return None
+    ttl = FOUND_TTL if coordinates else NOT_FOUND_TTL
+    set_local_cache(cache_key, coordinates, ttl)
+    if redis_db is not None:
+        redis_db.set(cache_key, json.dumps(coordinates), ex=ttl)
+    return coordinates
@@ -0,0 +1,212 @@
+import bisect
+import contextvars
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS_HELP = {
+    'bot_handler_duration_seconds': (
+        'histogram',
+        'Time spent in conversation handlers'
+    ),
+    'bot_handler_errors_total': (
+        'counter',
+        'Conversation handlers that raised an exception'
+    ),
+    'bot_handler_upstream_seconds_total': (
+        'counter',
+        'Time conversation handlers spent waiting for upstream requests'
+    ),
+    'upstream_request_duration_seconds': (
+        'histogram',
+        'Time spent in requests to Elastic Path and the geocoder'
+    ),
+    'upstream_request_errors_total': (
+        'counter',
+        'Upstream requests that failed or got an error status'
+    ),
+    'upstream_circuit_open_total': (
+        'counter',
+        'Upstream requests rejected by an open circuit breaker'
+    ),
+    'cart_reads_total': (
+        'counter',
+        'Cart reads answered from the mirror or fetched from Elastic Path'
+    ),
+    'cart_reconciliations_total': (
+        'counter',
+        'Carts fetched from Elastic Path past the mirror before payment'
+    ),
+    'telegram_outbound_queue_depth': (
+        'gauge',
+        'Telegram requests waiting in the outbound queue'
+    ),
+    'telegram_outbound_wait_seconds': (
+        'histogram',
+        'Time Telegram requests spent in the outbound queue'
+    ),
+    'telegram_outbound_retry_after_total': (
+        'counter',
+        'Telegram requests answered with "Too Many Requests"'
+    ),
+    'telegram_screen_renders_total': (
+        'counter',
+        'Cart and menu screens edited or skipped as unchanged'
+    ),
+}
+
+# (metric name, labels) -> [bucket counts, sum, count]
+HISTOGRAMS = {}
+# (metric name, labels) -> value
+COUNTERS = {}
+GAUGES = {}
+METRICS_LOCK = threading.Lock()
+
+CURRENT_HANDLER = contextvars.ContextVar('current_handler', default=None)
+
+
+def get_labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(metric_name, labels, value):
+    key = (metric_name, get_labels_key(labels))
+    bucket_index = bisect.bisect_left(LATENCY_BUCKETS, value)
+    with METRICS_LOCK:
+        histogram = HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+            HISTOGRAMS[key] = histogram
+        histogram[0][bucket_index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def increment(metric_name, labels, value=1):
+    key = (metric_name, get_labels_key(labels))
+    with METRICS_LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+def set_gauge(metric_name, labels, value):
+    key = (metric_name, get_labels_key(labels))
+    with METRICS_LOCK:
+        GAUGES[key] = value
+
+
+def record_upstream_request(upstream, endpoint, method, seconds, failed):
+    labels = {'upstream': upstream, 'endpoint': endpoint, 'method': method}
+    observe('upstream_request_duration_seconds', labels, seconds)
+    if failed:
+        increment('upstream_request_errors_total', labels)
+    handler_labels = CURRENT_HANDLER.get()
+    if handler_labels is not None:
+        increment(
+            'bot_handler_upstream_seconds_total',
+            {**handler_labels, 'upstream': upstream, 'endpoint': endpoint},
+            seconds
+        )
+
+
+def get_callback_name(callback):
+    # Handlers with injected dependencies are functools.partial objects.
+    callback = getattr(callback, 'func', callback)
+    return getattr(callback, '__name__', repr(callback))
+
+
+def measure_handler(callback, state_name):
+    handler_labels = {
+        'handler': get_callback_name(callback),
+        'state': state_name,
+    }
+
+    def measured_callback(update, context):
+        context_token = CURRENT_HANDLER.set(handler_labels)
+        started_at = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            increment('bot_handler_errors_total', handler_labels)
+            raise
+        finally:
+            observe(
+                'bot_handler_duration_seconds',
+                handler_labels,
+                time.perf_counter() - started_at
+            )
+            CURRENT_HANDLER.reset(context_token)
+
+    return measured_callback
+
+
+def measure_conversation_handler(conversation_handler):
+    handler_groups = [('entry', conversation_handler.entry_points)]
+    handler_groups += [
+        (getattr(state, 'name', str(state)), handlers)
+        for state, handlers in conversation_handler.states.items()
+    ]
+    handler_groups.append(('fallback', conversation_handler.fallbacks))
+    for state_name, handlers in handler_groups:
+        for handler in handlers:
+            handler.callback = measure_handler(handler.callback, state_name)
+
+
+def submit_in_context(executor, function, *args):
+    # Upstream calls made in the executor are still counted for the
+    # handler that submitted them.
+    context = contextvars.copy_context()
+    return executor.submit(context.run, function, *args)
+
+
+def format_labels(labels_key, extra_labels=()):
+    labels = list(labels_key) + list(extra_labels)
+    if not labels:
+        return ''
+    formatted_labels = []
+    for label_name, label_value in labels:
+        label_value = str(label_value).replace('\\', '\\\\') \
+            .replace('"', '\\"').replace('\n', '\\n')
+        formatted_labels.append(f'{label_name}="{label_value}"')
+    return '{' + ','.join(formatted_labels) + '}'
+
+
+def render_metrics():
+    with METRICS_LOCK:
+        histograms = {
+            key: (list(buckets), total, count)
+            for key, (buckets, total, count) in HISTOGRAMS.items()
+        }
+        counters = dict(COUNTERS)
+        gauges = dict(GAUGES)
+    lines = []
+    for metric_name, (metric_type, metric_help) in METRICS_HELP.items():
+        lines.append(f'# HELP {metric_name} {metric_help}')
+        lines.append(f'# TYPE {metric_name} {metric_type}')
+        if metric_type == 'histogram':
+            for (name, labels_key), histogram in sorted(histograms.items()):
+                if name != metric_name:
+                    continue
+                buckets, total, count = histogram
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                    cumulative_count += bucket_count
+                    bucket_labels = format_labels(
+                        labels_key,
+                        [('le', upper_bound)]
+                    )
+                    lines.append(
+                        f'{name}_bucket{bucket_labels} {cumulative_count}'
+                    )
+                bucket_labels = format_labels(labels_key, [('le', '+Inf')])
+                lines.append(f'{name}_bucket{bucket_labels} {count}')
+                lines.append(f'{name}_sum{format_labels(labels_key)} {total}')
+                lines.append(
+                    f'{name}_count{format_labels(labels_key)} {count}'
+                )
+        else:
+            values = gauges if metric_type == 'gauge' else counters
+            for (name, labels_key), value in sorted(values.items()):
+                if name == metric_name:
+                    lines.append(f'{name}{format_labels(labels_key)} {value}')
+    return '\n'.join(lines) + '\n'
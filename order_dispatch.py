@@ -0,0 +1,236 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+import requests
+
+from cart_mirror import get_cart
+from elastic_path_api import create_customer
+from outbound_queue import PRIORITY_BACKGROUND, SEND_PRIORITY
+from pizzeria_locator import get_pizzeria
+
+ORDER_QUEUE_KEY = 'orders'
+ORDER_RETRIES_KEY = 'orders:retries'
+FAILED_ORDERS_KEY = 'orders:failed'
+DEFAULT_ORDER_WORKERS = 2
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 10
+QUEUE_TIMEOUT = 5
+WORKER_LOCK_TIMEOUT = 30
+
+# Moves retries that are due back to the queue in one step, so an order
+# is never in neither of them.
+MOVE_DUE_RETRIES_SCRIPT = '''
+local orders = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                          'LIMIT', 0, 100)
+for _, order in ipairs(orders) do
+    redis.call('ZREM', KEYS[1], order)
+    redis.call('RPUSH', KEYS[2], order)
+end
+return #orders
+'''
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_order(redis_db, order):
+    order = {
+        'order_id': uuid.uuid4().hex,
+        'attempts': 0,
+        'done_steps': [],
+        **order,
+    }
+    redis_db.lpush(ORDER_QUEUE_KEY, json.dumps(order))
+    return order['order_id']
+
+
+def get_order_cart_items(order, redis_db):
+    if order.get('cart_items') is None:
+        order['cart_items'] = get_cart(order['chat_id'], redis_db)['data']
+    return order['cart_items']
+
+
+def send_courier_message(bot, redis_db, order):
+    pizzeria = get_pizzeria(order['pizzeria_id'])
+    cart_items = get_order_cart_items(order, redis_db)
+    products_list_message = '\n'.join(
+        [f'{item["name"]}: {item["quantity"]} шт.' for item in cart_items]
+    )
+    if order['delivery_type'] == 'free':
+        delivery_message = f'{order["name"]} оставил новый заказ:\n\n' \
+                           f'{products_list_message}\n\n' \
+                           'Клиент заберет его самостоятельно.'
+    else:
+        delivery_message = f'{order["name"]} оставил новый заказ:\n\n' \
+                           f'{products_list_message}\n\n' \
+                           f'Адрес доставки находится в ' \
+                           f'{order["pizzeria_distance"]:.2f} км, вот здесь:'
+    bot.send_message(
+        chat_id=pizzeria['delivery_chat_id'],
+        text=delivery_message,
+    )
+
+
+def send_courier_location(bot, redis_db, order):
+    if order['delivery_type'] == 'free':
+        return
+    pizzeria = get_pizzeria(order['pizzeria_id'])
+    bot.send_location(
+        chat_id=pizzeria['delivery_chat_id'],
+        longitude=order['longitude'],
+        latitude=order['latitude']
+    )
+
+
+def save_customer(bot, redis_db, order):
+    try:
+        create_customer(
+            order['name'],
+            order['email'],
+            order['latitude'],
+            order['longitude']
+        )
+    except requests.HTTPError as error:
+        status_code = error.response.status_code \
+            if error.response is not None else None
+        # A rejected customer, such as one with a taken email, is rejected
+        # on every retry too. Rate limits and 5xx answers are retried.
+        if status_code is None or status_code == 429 or status_code >= 500:
+            raise
+        logger.warning(
+            'Customer of order %s was rejected with %s, not saved',
+            order['order_id'],
+            status_code,
+            exc_info=True
+        )
+
+
+# Finished steps are stored in the order, a retry only repeats the step
+# that failed. A crash in the middle of a step still repeats it.
+ORDER_STEPS = [
+    ('courier_message', send_courier_message),
+    ('courier_location', send_courier_location),
+    ('customer', save_customer),
+]
+
+
+def process_order(bot, redis_db, order):
+    for step_name, step in ORDER_STEPS:
+        if step_name in order['done_steps']:
+            continue
+        step(bot, redis_db, order)
+        order['done_steps'].append(step_name)
+
+
+def get_processing_key(slot):
+    return f'{ORDER_QUEUE_KEY}:processing:{slot}'
+
+
+def requeue_unfinished_orders(redis_db, slot):
+    processing_key = get_processing_key(slot)
+    unfinished_orders = redis_db.lrange(processing_key, 0, -1)
+    pipeline = redis_db.pipeline()
+    for order in unfinished_orders:
+        pipeline.rpush(ORDER_QUEUE_KEY, order)
+    pipeline.delete(processing_key)
+    pipeline.execute()
+    return len(unfinished_orders)
+
+
+def finish_order(redis_db, processing_key, raw_order, order, failed, now):
+    pipeline = redis_db.pipeline()
+    if failed:
+        order['attempts'] += 1
+        if order['attempts'] >= MAX_ATTEMPTS:
+            logger.error(
+                'Order %s failed %s times, moved to %s',
+                order['order_id'],
+                order['attempts'],
+                FAILED_ORDERS_KEY
+            )
+            pipeline.lpush(FAILED_ORDERS_KEY, json.dumps(order))
+        else:
+            retry_delay = RETRY_BACKOFF * 2 ** (order['attempts'] - 1)
+            pipeline.zadd(
+                ORDER_RETRIES_KEY,
+                {json.dumps(order): now + retry_delay}
+            )
+    pipeline.lrem(processing_key, 1, raw_order)
+    pipeline.execute()
+
+
+def run_order_worker(redis_db, bot, slot, clock=time.time):
+    # Every slot is served by one worker at a time, a worker of another
+    # bot process takes the slot over if this one dies.
+    processing_key = get_processing_key(slot)
+    worker_lock = redis_db.lock(
+        f'{ORDER_QUEUE_KEY}:worker:{slot}',
+        timeout=WORKER_LOCK_TIMEOUT
+    )
+    move_due_retries = redis_db.register_script(MOVE_DUE_RETRIES_SCRIPT)
+    while not worker_lock.acquire(blocking=False):
+        time.sleep(WORKER_LOCK_TIMEOUT / 2)
+    try:
+        requeued_count = requeue_unfinished_orders(redis_db, slot)
+        if requeued_count:
+            logger.warning(
+                'Requeued %s unfinished orders of slot %s',
+                requeued_count,
+                slot
+            )
+        while True:
+            worker_lock.reacquire()
+            move_due_retries(
+                keys=[ORDER_RETRIES_KEY, ORDER_QUEUE_KEY],
+                args=[clock()]
+            )
+            raw_order = redis_db.brpoplpush(
+                ORDER_QUEUE_KEY,
+                processing_key,
+                timeout=QUEUE_TIMEOUT
+            )
+            if raw_order is None:
+                continue
+            order = json.loads(raw_order)
+            failed = False
+            try:
+                process_order(bot, redis_db, order)
+            except Exception:
+                logger.exception('Order %s failed', order['order_id'])
+                failed = True
+            finish_order(
+                redis_db,
+                processing_key,
+                raw_order,
+                order,
+                failed,
+                clock()
+            )
+    finally:
+        worker_lock.release()
+
+
+def keep_order_worker_running(redis_db, bot, slot):
+    SEND_PRIORITY.set(PRIORITY_BACKGROUND)
+    while True:
+        try:
+            run_order_worker(redis_db, bot, slot)
+        except Exception:
+            logger.exception('Order worker %s stopped, restarting it', slot)
+            time.sleep(QUEUE_TIMEOUT)
+
+
+def start_order_workers(redis_db, bot, workers_count=DEFAULT_ORDER_WORKERS):
+    threads = []
+    for slot in range(workers_count):
+        thread = threading.Thread(
+            target=keep_order_worker_running,
+            args=(redis_db, bot, slot),
+            name=f'order-worker-{slot}',
+            daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+    return threads
@@ -0,0 +1,322 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+from metrics import increment, observe, set_gauge
+
+PRIORITY_REPLY = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = {PRIORITY_REPLY: 'reply', PRIORITY_BACKGROUND: 'background'}
+
+# Telegram allows about 30 messages per second overall, one per second in
+# a private chat with short bursts and 20 per minute in a group.
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 5
+GROUP_RATE = 20 / 60
+GROUP_BURST = 5
+DEFAULT_OUTBOUND_WORKERS = 8
+MAX_RETRY_AFTER_ATTEMPTS = 3
+BUCKETS_PRUNE_INTERVAL = 60
+
+# Background work such as courier notices and follow-ups sets it to
+# PRIORITY_BACKGROUND, so customers' replies are sent first.
+SEND_PRIORITY = contextvars.ContextVar('send_priority', default=PRIORITY_REPLY)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    def refill(self, now):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def get_wait(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundRequest:
+    def __init__(self, chat_id, method, args, kwargs, priority, order,
+                 queued_at):
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.order = order
+        self.queued_at = queued_at
+        self.retry_after_attempts = 0
+        self.future = Future()
+
+
+class OutboundQueue:
+    # Requests of one chat are sent one by one in the order they were
+    # queued. Chats whose next request may be sent wait in the ready
+    # heap by priority, chats that are out of tokens or were asked to
+    # retry later wait in the delayed heap by time.
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                 chat_burst=CHAT_BURST, group_rate=GROUP_RATE,
+                 group_burst=GROUP_BURST, clock=time.monotonic):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.clock = clock
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock())
+        self.chat_buckets = {}
+        self.chat_requests = {}
+        self.paused_chats = {}
+        self.ready_chats = []
+        self.delayed_chats = []
+        self.depths = {priority: 0 for priority in PRIORITY_NAMES}
+        self.orders = itertools.count()
+        self.condition = threading.Condition()
+        self.pruned_at = clock()
+
+    def get_chat_bucket(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Group ids are negative, channels may be given by @username.
+            if str(chat_id).startswith(('-', '@')):
+                bucket = TokenBucket(self.group_rate, self.group_burst, now)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def prune_chat_buckets(self, now):
+        # A full bucket is the same as a new one.
+        if now - self.pruned_at < BUCKETS_PRUNE_INTERVAL:
+            return
+        self.pruned_at = now
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in self.chat_requests and bucket.is_full(now):
+                del self.chat_buckets[chat_id]
+
+    def update_depth(self, priority, change):
+        self.depths[priority] += change
+        set_gauge(
+            'telegram_outbound_queue_depth',
+            {'priority': PRIORITY_NAMES[priority]},
+            self.depths[priority]
+        )
+
+    def push_ready_chat(self, chat_id):
+        request = self.chat_requests[chat_id][0]
+        heapq.heappush(
+            self.ready_chats,
+            (request.priority, request.order, chat_id)
+        )
+
+    def put(self, chat_id, method, args, kwargs):
+        with self.condition:
+            request = OutboundRequest(
+                chat_id,
+                method,
+                args,
+                kwargs,
+                SEND_PRIORITY.get(),
+                next(self.orders),
+                self.clock()
+            )
+            self.update_depth(request.priority, 1)
+            chat_queue = self.chat_requests.get(chat_id)
+            if chat_queue is None:
+                self.chat_requests[chat_id] = deque([request])
+                self.push_ready_chat(chat_id)
+                self.condition.notify()
+            else:
+                chat_queue.append(request)
+        return request.future
+
+    def take(self):
+        with self.condition:
+            while True:
+                now = self.clock()
+                while self.delayed_chats and self.delayed_chats[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self.delayed_chats)
+                    self.push_ready_chat(chat_id)
+                wait = None
+                if self.ready_chats:
+                    wait = self.global_bucket.get_wait(now)
+                    if not wait:
+                        _, _, chat_id = heapq.heappop(self.ready_chats)
+                        chat_wait = max(
+                            self.get_chat_bucket(chat_id, now).get_wait(now),
+                            self.paused_chats.get(chat_id, now) - now
+                        )
+                        if chat_wait > 0:
+                            heapq.heappush(
+                                self.delayed_chats,
+                                (now + chat_wait, next(self.orders), chat_id)
+                            )
+                            continue
+                        self.paused_chats.pop(chat_id, None)
+                        self.global_bucket.take(now)
+                        self.chat_buckets[chat_id].take(now)
+                        # The chat leaves both heaps until its request is
+                        # sent, so its next one cannot overtake it.
+                        request = self.chat_requests[chat_id].popleft()
+                        self.update_depth(request.priority, -1)
+                        self.prune_chat_buckets(now)
+                        return request
+                if self.delayed_chats:
+                    delayed_wait = self.delayed_chats[0][0] - now
+                    wait = delayed_wait if wait is None \
+                        else min(wait, delayed_wait)
+                self.condition.wait(wait)
+
+    def finish(self, request, retry_after=None):
+        with self.condition:
+            chat_id = request.chat_id
+            if retry_after is not None:
+                now = self.clock()
+                self.paused_chats[chat_id] = now + retry_after
+                self.chat_requests[chat_id].appendleft(request)
+                self.update_depth(request.priority, 1)
+                heapq.heappush(
+                    self.delayed_chats,
+                    (now + retry_after, next(self.orders), chat_id)
+                )
+            elif self.chat_requests[chat_id]:
+                self.push_ready_chat(chat_id)
+            else:
+                del self.chat_requests[chat_id]
+            self.condition.notify()
+
+    def send(self, request):
+        observe(
+            'telegram_outbound_wait_seconds',
+            {'priority': PRIORITY_NAMES[request.priority]},
+            self.clock() - request.queued_at
+        )
+        for argument in request.kwargs.values():
+            # An opened photo is read again when the request is retried.
+            if hasattr(argument, 'seek'):
+                argument.seek(0)
+        try:
+            result = request.method(*request.args, **request.kwargs)
+        except RetryAfter as error:
+            increment(
+                'telegram_outbound_retry_after_total',
+                {'priority': PRIORITY_NAMES[request.priority]}
+            )
+            request.retry_after_attempts += 1
+            if request.retry_after_attempts < MAX_RETRY_AFTER_ATTEMPTS:
+                logger.warning(
+                    'Telegram asked to wait %s s before sending to %s',
+                    error.retry_after,
+                    request.chat_id
+                )
+                self.finish(request, retry_after=error.retry_after)
+                return
+            request.future.set_exception(error)
+        except Exception as error:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(result)
+        self.finish(request)
+
+    def run_worker(self):
+        while True:
+            self.send(self.take())
+
+    def start_workers(self, workers_count=DEFAULT_OUTBOUND_WORKERS):
+        threads = []
+        for worker_number in range(workers_count):
+            thread = threading.Thread(
+                target=self.run_worker,
+                name=f'telegram-outbound-{worker_number}',
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+        return threads
+
+
+def get_chat_id(args, kwargs, position):
+    if 'chat_id' in kwargs:
+        return kwargs['chat_id']
+    return args[position] if len(args) > position else None
+
+
+class QueuedBot(ExtBot):
+    # Calls that may hit Telegram flood limits go through the outbound
+    # queue, the calling thread waits until the request is sent.
+    def __init__(self, *args, outbound_queue=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound_queue = outbound_queue or OutboundQueue()
+
+    def queue_request(self, method, args, kwargs, chat_id_position=0):
+        future = self.outbound_queue.put(
+            get_chat_id(args, kwargs, chat_id_position),
+            method,
+            args,
+            kwargs
+        )
+        return future.result()
+
+    def send_message(self, *args, **kwargs):
+        return self.queue_request(super().send_message, args, kwargs)
+
+    def send_photo(self, *args, **kwargs):
+        return self.queue_request(super().send_photo, args, kwargs)
+
+    def send_location(self, *args, **kwargs):
+        return self.queue_request(super().send_location, args, kwargs)
+
+    def send_invoice(self, *args, **kwargs):
+        return self.queue_request(super().send_invoice, args, kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self.queue_request(
+            super().edit_message_text,
+            args,
+            kwargs,
+            chat_id_position=1
+        )
+
+    def edit_message_caption(self, *args, **kwargs):
+        return self.queue_request(
+            super().edit_message_caption,
+            args,
+            kwargs
+        )
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        return self.queue_request(
+            super().edit_message_reply_markup,
+            args,
+            kwargs
+        )
+
+    def delete_message(self, *args, **kwargs):
+        return self.queue_request(super().delete_message, args, kwargs)
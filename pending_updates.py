@@ -0,0 +1,74 @@
+from telegram.ext import ConversationHandler, Handler
+
+
+def resolve_pending_state(state):
+    # A state may be (old state, promise), and the old state may be such a
+    # pair again when several updates came in a row.
+    while isinstance(state, tuple):
+        old_state, promise = state
+        try:
+            new_state = promise.result()
+        except Exception:
+            new_state = None
+        state = old_state if new_state is None else new_state
+    return state
+
+
+def find_state_handler(conversation_handler, state, update):
+    if state is None or state == ConversationHandler.END:
+        handlers = conversation_handler.entry_points
+    else:
+        handlers = conversation_handler.states.get(state, []) \
+            + conversation_handler.fallbacks
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler, check
+    return None, None
+
+
+class PendingUpdateHandler(Handler):
+    # ConversationHandler sends updates that come while the chat's previous
+    # update is still handled to the WAITING state. This handler waits for
+    # the previous one and passes the update to the handler of the state it
+    # returned, so quick taps are handled in order instead of dropped.
+    def __init__(self, conversation_handler):
+        super().__init__(self.handle_pending_update)
+        self.conversation_handler = conversation_handler
+
+    def check_update(self, update):
+        key = self.conversation_handler._get_key(update)
+        with self.conversation_handler._conversations_lock:
+            return self.conversation_handler.conversations.get(key)
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        return dispatcher.run_async(
+            self.handle_pending_update,
+            update,
+            dispatcher,
+            check_result,
+            context,
+            update=update
+        )
+
+    def handle_pending_update(self, update, dispatcher, pending_state,
+                              context):
+        # Promises run in the order they were queued, so the one waited for
+        # has already been taken by another worker.
+        state = resolve_pending_state(pending_state)
+        handler, check = find_state_handler(
+            self.conversation_handler,
+            state,
+            update
+        )
+        if handler is None:
+            return state
+        handler.collect_additional_context(context, update, dispatcher, check)
+        new_state = handler.callback(update, context)
+        return state if new_state is None else new_state
+
+
+def handle_pending_updates(conversation_handler):
+    conversation_handler.states[ConversationHandler.WAITING] = [
+        PendingUpdateHandler(conversation_handler)
+    ]
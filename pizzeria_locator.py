@@ -0,0 +1,153 @@
+import heapq
+import math
+import threading
+
+import numpy as np
+from geopy import distance
+
+from elastic_path_api import get_all_entries, get_entry
+from geo_distances import haversine_distances
+
+CANDIDATES_COUNT = 5
+# Up to this many pizzerias one vectorized scan is cheaper than walking
+# the pure python k-d tree.
+VECTOR_SCAN_LIMIT = 5000
+
+PIZZERIAS = {
+    'entries': None,
+    'by_id': None,
+    'coordinates': None,
+    'tree': None,
+}
+PIZZERIAS_LOCK = threading.Lock()
+
+
+def to_unit_vector(latitude, longitude):
+    # Chord length between unit vectors grows monotonically with the
+    # great-circle distance, so a plain euclidean k-d tree over them
+    # finds the nearest points on the sphere.
+    latitude = math.radians(float(latitude))
+    longitude = math.radians(float(longitude))
+    return (
+        math.cos(latitude) * math.cos(longitude),
+        math.cos(latitude) * math.sin(longitude),
+        math.sin(latitude),
+    )
+
+
+def build_kd_tree(points, depth=0):
+    if not points:
+        return None
+    axis = depth % 3
+    points.sort(key=lambda point: point[0][axis])
+    median = len(points) // 2
+    return (
+        points[median],
+        axis,
+        build_kd_tree(points[:median], depth + 1),
+        build_kd_tree(points[median + 1:], depth + 1),
+    )
+
+
+def query_kd_tree(node, target, count, nearest):
+    if node is None:
+        return
+    (point, index), axis, left, right = node
+    squared_distance = sum(
+        (target_coord - point_coord) ** 2
+        for target_coord, point_coord in zip(target, point)
+    )
+    if len(nearest) < count:
+        heapq.heappush(nearest, (-squared_distance, index))
+    elif squared_distance < -nearest[0][0]:
+        heapq.heapreplace(nearest, (-squared_distance, index))
+    axis_difference = target[axis] - point[axis]
+    if axis_difference < 0:
+        near_branch, far_branch = left, right
+    else:
+        near_branch, far_branch = right, left
+    query_kd_tree(near_branch, target, count, nearest)
+    if len(nearest) < count or axis_difference ** 2 < -nearest[0][0]:
+        query_kd_tree(far_branch, target, count, nearest)
+
+
+def load_pizzerias():
+    pizzerias = get_all_entries('pizzerias')
+    points = [
+        (to_unit_vector(pizzeria['lat'], pizzeria['lon']), index)
+        for index, pizzeria in enumerate(pizzerias)
+    ]
+    coordinates = np.array(
+        [(pizzeria['lat'], pizzeria['lon']) for pizzeria in pizzerias],
+        dtype=np.float64
+    )
+    tree = build_kd_tree(points)
+    with PIZZERIAS_LOCK:
+        PIZZERIAS['entries'] = pizzerias
+        PIZZERIAS['by_id'] = {
+            pizzeria['id']: pizzeria for pizzeria in pizzerias
+        }
+        PIZZERIAS['coordinates'] = coordinates
+        PIZZERIAS['tree'] = tree
+    return pizzerias
+
+
+def get_pizzerias_index():
+    with PIZZERIAS_LOCK:
+        pizzerias_index = dict(PIZZERIAS)
+    if pizzerias_index['entries'] is None:
+        load_pizzerias()
+        with PIZZERIAS_LOCK:
+            pizzerias_index = dict(PIZZERIAS)
+    return pizzerias_index
+
+
+def find_candidate_indexes(pizzerias_index, position, count):
+    if len(pizzerias_index['entries']) <= VECTOR_SCAN_LIMIT:
+        distances = haversine_distances(
+            position,
+            pizzerias_index['coordinates']
+        )
+        if count >= len(distances):
+            return range(len(distances))
+        return np.argpartition(distances, count - 1)[:count]
+    nearest = []
+    query_kd_tree(
+        pizzerias_index['tree'],
+        to_unit_vector(*position),
+        count,
+        nearest
+    )
+    return [pizzeria_index for _, pizzeria_index in nearest]
+
+
+def find_nearest_pizzerias(position, count=CANDIDATES_COUNT):
+    pizzerias_index = get_pizzerias_index()
+    pizzerias = pizzerias_index['entries']
+    candidate_indexes = find_candidate_indexes(
+        pizzerias_index,
+        position,
+        count
+    )
+    candidates = []
+    for candidate_index in candidate_indexes:
+        pizzeria = dict(pizzerias[candidate_index])
+        pizzeria['distance'] = distance.distance(
+            position,
+            (pizzeria['lat'], pizzeria['lon'])
+        ).km
+        candidates.append(pizzeria)
+    candidates.sort(key=lambda pizzeria: pizzeria['distance'])
+    return candidates
+
+
+def get_pizzeria(pizzeria_id):
+    pizzerias_index = get_pizzerias_index()
+    pizzeria = pizzerias_index['by_id'].get(pizzeria_id)
+    if pizzeria is None:
+        pizzeria = get_entry('pizzerias', pizzeria_id)
+    return pizzeria
+
+
+def find_nearest_pizzeria(position):
+    return find_nearest_pizzerias(position)[0]
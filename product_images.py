@@ -0,0 +1,101 @@
+import hashlib
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+from elastic_path_api import fetch_file, download_file, fetch_products
+
+IMAGE_DIRECTORY = Path('./images')
+IMAGE_INDEX_PATH = Path(IMAGE_DIRECTORY, 'index.json')
+# Telegram shows photos at most 1280 px wide, chat previews are much
+# smaller, so 800 px keeps pizzas sharp at a fraction of the upload size.
+MAX_IMAGE_SIDE = 800
+JPEG_QUALITY = 80
+
+IMAGE_INDEX = {
+    'images': None,
+}
+IMAGE_INDEX_LOCK = threading.Lock()
+
+
+def prepare_image(image_content):
+    with Image.open(io.BytesIO(image_content)) as image:
+        image = image.convert('RGB')
+        image.thumbnail(
+            (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE),
+            Image.Resampling.LANCZOS
+        )
+        prepared_image = io.BytesIO()
+        image.save(
+            prepared_image,
+            format='JPEG',
+            quality=JPEG_QUALITY,
+            optimize=True,
+            progressive=True
+        )
+    return prepared_image.getvalue()
+
+
+def store_image(image_content):
+    prepared_image = prepare_image(image_content)
+    content_hash = hashlib.sha256(prepared_image).hexdigest()
+    image_path = Path(IMAGE_DIRECTORY, f'{content_hash}.jpg')
+    if not image_path.exists():
+        temporary_path = image_path.with_suffix(f'.{threading.get_ident()}')
+        temporary_path.write_bytes(prepared_image)
+        os.replace(temporary_path, image_path)
+    return image_path
+
+
+def load_image_index():
+    Path.mkdir(IMAGE_DIRECTORY, exist_ok=True)
+    if not IMAGE_INDEX_PATH.exists():
+        return {}
+    with open(IMAGE_INDEX_PATH, 'r', encoding='utf-8') as index_file:
+        return json.load(index_file)
+
+
+def save_image_index(images):
+    temporary_path = IMAGE_INDEX_PATH.with_suffix('.tmp')
+    with open(temporary_path, 'w', encoding='utf-8') as index_file:
+        json.dump(images, index_file)
+    os.replace(temporary_path, IMAGE_INDEX_PATH)
+
+
+def get_product_image(file_id):
+    with IMAGE_INDEX_LOCK:
+        if IMAGE_INDEX['images'] is None:
+            IMAGE_INDEX['images'] = load_image_index()
+        image_name = IMAGE_INDEX['images'].get(file_id)
+    if image_name:
+        image_path = Path(IMAGE_DIRECTORY, image_name)
+        if image_path.exists():
+            return image_path
+    file_metadata = fetch_file(file_id)
+    image_content = download_file(file_metadata['link']['href'])
+    image_path = store_image(image_content)
+    with IMAGE_INDEX_LOCK:
+        IMAGE_INDEX['images'][file_id] = image_path.name
+        save_image_index(IMAGE_INDEX['images'])
+    return image_path
+
+
+def get_main_image_ids(products):
+    return [
+        product['relationships']['main_image']['data']['id']
+        for product in products
+        if product.get('relationships', {}).get('main_image')
+    ]
+
+
+def warm_up_product_images(workers=8, image_ids=None):
+    if image_ids is None:
+        image_ids = get_main_image_ids(fetch_products())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        image_paths = list(executor.map(get_product_image, image_ids))
+    return image_paths
@@ -0,0 +1,196 @@
+import json
+import pickle
+import threading
+from collections import defaultdict
+from functools import partial
+
+from telegram.ext import BasePersistence, ConversationHandler
+
+
+class LazyUserData(defaultdict):
+    def __init__(self, load_user_data):
+        super().__init__(dict)
+        self.load_user_data = load_user_data
+
+    def __missing__(self, user_id):
+        user_data = self.load_user_data(user_id)
+        self[user_id] = user_data
+        return user_data
+
+    def __copy__(self):
+        # BasePersistence copies whatever get_user_data returns to insert
+        # the bot instance and then refills the copy from copy(). The lazy
+        # mapping has to survive that, so it hands over itself.
+        return self
+
+    def copy(self):
+        return dict(self)
+
+
+class LazyConversations(dict):
+    def __init__(self, load_state):
+        super().__init__()
+        self.load_state = load_state
+        self.loaded_keys = set()
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        with self.lock:
+            if key in self.loaded_keys:
+                return
+            state = self.load_state(key)
+            if state is not None and not dict.__contains__(self, key):
+                dict.__setitem__(self, key, state)
+            self.loaded_keys.add(key)
+
+    def get(self, key, default=None):
+        self.load(key)
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self.load(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        self.load(key)
+        return super().__getitem__(key)
+
+
+class RedisHashPersistence(BasePersistence):
+    def __init__(self, redis_db, prefix='bot'):
+        super().__init__(
+            store_user_data=True,
+            store_chat_data=False,
+            store_bot_data=False
+        )
+        self.redis_db = redis_db
+        self.prefix = prefix
+        self.user_data_snapshots = {}
+        self.conversation_snapshots = {}
+        self.snapshots_lock = threading.Lock()
+
+    def get_user_data_key(self, user_id):
+        return f'{self.prefix}:user_data:{user_id}'
+
+    def get_conversations_key(self, name):
+        return f'{self.prefix}:conversations:{name}'
+
+    @staticmethod
+    def get_conversation_field(key):
+        return json.dumps(key)
+
+    def load_user_data(self, user_id):
+        stored_fields = self.redis_db.hgetall(self.get_user_data_key(user_id))
+        snapshot = {
+            field.decode(): value.decode()
+            for field, value in stored_fields.items()
+        }
+        with self.snapshots_lock:
+            self.user_data_snapshots[user_id] = snapshot
+        return {field: json.loads(value) for field, value in snapshot.items()}
+
+    def get_user_data(self):
+        return LazyUserData(self.load_user_data)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        conversations_key = self.get_conversations_key(name)
+
+        def load_state(key):
+            field = self.get_conversation_field(key)
+            stored_state = self.redis_db.hget(conversations_key, field)
+            with self.snapshots_lock:
+                self.conversation_snapshots[(name, key)] = stored_state
+            if stored_state is None:
+                return None
+            return pickle.loads(stored_state)
+
+        return LazyConversations(load_state)
+
+    def update_conversation(self, name, key, new_state):
+        if isinstance(new_state, tuple):
+            # The handler is still running in the worker pool.
+            # ConversationHandler resolves the promise only on the chat's
+            # next update, so the state is saved as soon as the handler is
+            # done, not one step late.
+            promise = new_state[-1]
+            promise.add_done_callback(
+                partial(self.save_resolved_state, name, key)
+            )
+            return
+        self.save_conversation(name, key, new_state)
+
+    def save_resolved_state(self, name, key, new_state):
+        # None keeps the state the conversation was in.
+        if new_state is None:
+            return
+        if new_state == ConversationHandler.END:
+            new_state = None
+        self.save_conversation(name, key, new_state)
+
+    def save_conversation(self, name, key, new_state):
+        conversations_key = self.get_conversations_key(name)
+        field = self.get_conversation_field(key)
+        stored_state = None if new_state is None else pickle.dumps(new_state)
+        with self.snapshots_lock:
+            if self.conversation_snapshots.get((name, key)) == stored_state:
+                return
+            self.conversation_snapshots[(name, key)] = stored_state
+        if stored_state is None:
+            self.redis_db.hdel(conversations_key, field)
+        else:
+            self.redis_db.hset(conversations_key, field, stored_state)
+
+    def update_user_data(self, user_id, data):
+        encoded_fields = {
+            field: json.dumps(value, sort_keys=True)
+            for field, value in data.items()
+        }
+        with self.snapshots_lock:
+            snapshot = self.user_data_snapshots.get(user_id, {})
+            changed_fields = {
+                field: value for field, value in encoded_fields.items()
+                if snapshot.get(field) != value
+            }
+            removed_fields = [
+                field for field in snapshot if field not in encoded_fields
+            ]
+            self.user_data_snapshots[user_id] = encoded_fields
+        if not changed_fields and not removed_fields:
+            return
+        user_data_key = self.get_user_data_key(user_id)
+        pipeline = self.redis_db.pipeline(transaction=False)
+        if changed_fields:
+            pipeline.hset(user_data_key, mapping=changed_fields)
+        if removed_fields:
+            pipeline.hdel(user_data_key, *removed_fields)
+        pipeline.execute()
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def get_callback_data(self):
+        return None
+
+    def update_callback_data(self, data):
+        pass
+
+    def refresh_user_data(self, user_id, user_data):
+        pass
+
+    def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    def refresh_bot_data(self, bot_data):
+        pass
+
+    def flush(self):
+        pass
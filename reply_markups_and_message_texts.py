@@ -1,16 +1,46 @@
+import threading
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+MENU_PAGE_SIZE = 6
+
+MENU_PAGES = {
+    'key': None,
+    'pages': None,
+}
+MENU_PAGES_LOCK = threading.Lock()
+
+
+def get_product_category_id(product):
+    categories = (product.get('relationships', {})
+                         .get('categories', {})
+                         .get('data'))
+    if not categories:
+        return None
+    return categories[0]['id']
+
+
+def chunk_products(products, page_size, group_by_category):
+    if group_by_category:
+        categories = {}
+        for product in products:
+            category_id = get_product_category_id(product)
+            categories.setdefault(category_id, []).append(product)
+        product_groups = list(categories.values())
+    else:
+        product_groups = [products]
+    chunked_products = []
+    for product_group in product_groups:
+        chunked_products.extend(
+            product_group[i:i + page_size]
+            for i in range(0, len(product_group), page_size)
+        )
+    return chunked_products
+
 
-def get_main_menu_reply_markup(products, page=1):
+def build_main_menu_page(page_products, page, pages_count):
     keyboard = []
-    chunk_size = 6
-    chunked_products = [products[i:i + chunk_size] for i in range(
-        0,
-        len(products),
-        chunk_size
-    )]
-    chunk_number = page - 1
-    for product in chunked_products[chunk_number]:
+    for product in page_products:
         product_button = [InlineKeyboardButton(
             product['name'],
             callback_data=product['id']
@@ -18,7 +48,7 @@ def get_main_menu_reply_markup(products, page=1):
         keyboard.append(product_button)
     cart_button = [InlineKeyboardButton('Корзина', callback_data='cart')]
     keyboard.append(cart_button)
-    if len(chunked_products) > 1:
+    if pages_count > 1:
         if page == 1:
             previous_button = InlineKeyboardButton(
                 'Назад',
@@ -29,7 +59,7 @@ def get_main_menu_reply_markup(products, page=1):
                 'Назад',
                 callback_data=f'page_{page - 1}'
             )
-        if page == len(chunked_products):
+        if page == pages_count:
             next_button = InlineKeyboardButton(
                 'Вперед',
                 callback_data='page_inactive'
@@ -48,6 +78,37 @@ def get_main_menu_reply_markup(products, page=1):
     return reply_markup
 
 
+def build_main_menu_pages(products, page_size=MENU_PAGE_SIZE,
+                          group_by_category=False):
+    chunked_products = chunk_products(products, page_size, group_by_category)
+    if not chunked_products:
+        chunked_products = [[]]
+    pages_count = len(chunked_products)
+    return [
+        build_main_menu_page(page_products, page, pages_count)
+        for page, page_products in enumerate(chunked_products, start=1)
+    ]
+
+
+def get_main_menu_reply_markup(products, page=1, catalog_hash=None,
+                               page_size=MENU_PAGE_SIZE,
+                               group_by_category=False):
+    pages_key = (catalog_hash, page_size, group_by_category)
+    with MENU_PAGES_LOCK:
+        if catalog_hash is not None and MENU_PAGES['key'] == pages_key:
+            pages = MENU_PAGES['pages']
+        else:
+            pages = None
+    if pages is None:
+        pages = build_main_menu_pages(products, page_size, group_by_category)
+        if catalog_hash is not None:
+            with MENU_PAGES_LOCK:
+                MENU_PAGES['key'] = pages_key
+                MENU_PAGES['pages'] = pages
+    page = min(max(page, 1), len(pages))
+    return pages[page - 1]
+
+
 def get_cart_reply_markup(cart):
     keyboard = []
     for item in cart['data']:
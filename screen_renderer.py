@@ -0,0 +1,56 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from telegram.error import BadRequest
+
+from metrics import increment
+
+RENDERED_MESSAGES_SIZE = 100000
+
+# (chat id, message id) -> hash of the text and keyboard shown there
+RENDERED_MESSAGES = OrderedDict()
+RENDERED_MESSAGES_LOCK = threading.Lock()
+
+
+def get_render_hash(text, reply_markup):
+    markup_json = reply_markup.to_json() if reply_markup else ''
+    return hashlib.sha1(f'{text}\0{markup_json}'.encode()).hexdigest()
+
+
+def get_rendered_hash(message):
+    render_key = (message.chat_id, message.message_id)
+    with RENDERED_MESSAGES_LOCK:
+        render_hash = RENDERED_MESSAGES.get(render_key)
+        if render_hash is not None:
+            RENDERED_MESSAGES.move_to_end(render_key)
+            return render_hash
+    # Unknown after a restart, the pressed message shows what is there.
+    return get_render_hash(message.text, message.reply_markup)
+
+
+def set_rendered_hash(message, render_hash):
+    render_key = (message.chat_id, message.message_id)
+    with RENDERED_MESSAGES_LOCK:
+        RENDERED_MESSAGES[render_key] = render_hash
+        RENDERED_MESSAGES.move_to_end(render_key)
+        while len(RENDERED_MESSAGES) > RENDERED_MESSAGES_SIZE:
+            RENDERED_MESSAGES.popitem(last=False)
+
+
+def render_screen(callback_query, text, reply_markup):
+    # Text and keyboard are changed by one edit, so a failed request does
+    # not leave a message with the new text and the old buttons.
+    message = callback_query.message
+    render_hash = get_render_hash(text, reply_markup)
+    if get_rendered_hash(message) == render_hash:
+        increment('telegram_screen_renders_total', {'result': 'skipped'})
+        return False
+    try:
+        callback_query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as error:
+        if 'not modified' not in error.message.lower():
+            raise
+    set_rendered_hash(message, render_hash)
+    increment('telegram_screen_renders_total', {'result': 'edited'})
+    return True
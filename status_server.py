@@ -0,0 +1,57 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metrics import render_metrics
+from warm_up import get_warm_up_report
+
+logger = logging.getLogger(__name__)
+
+
+def get_readiness():
+    report = get_warm_up_report()
+    status = 200 if report['ready'] else 503
+    return status, 'application/json', json.dumps(report)
+
+
+def get_metrics():
+    return 200, 'text/plain; version=0.0.4', render_metrics()
+
+
+# Path -> function returning (HTTP status, content type, body).
+ROUTES = {
+    '/ready': get_readiness,
+    '/metrics': get_metrics,
+}
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        route = ROUTES.get(self.path)
+        if route is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        status, content_type, body = route()
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_status_server(port):
+    server = ThreadingHTTPServer(('', port), StatusHandler)
+    thread = threading.Thread(
+        target=server.serve_forever,
+        name='status-server',
+        daemon=True
+    )
+    thread.start()
+    logger.info('Status server is listening on port %s', port)
+    return server
@@ -0,0 +1,32 @@
+def get_photo_file_id(redis_db, image_id):
+    file_id = redis_db.get(f'telegram_file_id:{image_id}')
+    if file_id is None:
+        return None
+    return file_id.decode()
+
+
+def get_photo_file_ids(redis_db, image_ids):
+    if not image_ids:
+        return {}
+    file_ids = redis_db.mget(
+        [f'telegram_file_id:{image_id}' for image_id in image_ids]
+    )
+    return {
+        image_id: file_id.decode()
+        for image_id, file_id in zip(image_ids, file_ids)
+        if file_id is not None
+    }
+
+
+def save_photo_file_id(redis_db, product_id, image_id, file_id):
+    main_image_key = f'product_main_image:{product_id}'
+    previous_image_id = redis_db.getset(main_image_key, image_id)
+    pipeline = redis_db.pipeline()
+    if previous_image_id and previous_image_id.decode() != image_id:
+        pipeline.delete(f'telegram_file_id:{previous_image_id.decode()}')
+    pipeline.set(f'telegram_file_id:{image_id}', file_id)
+    pipeline.execute()
+
+
+def delete_photo_file_id(redis_db, image_id):
+    redis_db.delete(f'telegram_file_id:{image_id}')
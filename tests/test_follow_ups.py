@@ -0,0 +1,144 @@
+import random
+import unittest
+from collections import Counter
+
+from telegram.error import RetryAfter
+
+import follow_ups
+
+BURST_FOLLOW_UPS_COUNT = 300
+SPREAD_FOLLOW_UPS_COUNT = 200
+WORKERS_COUNT = 2
+RETRY_AFTER = 3
+
+
+class SimulatedClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class RecordingBot:
+    def __init__(self, clock, retry_after_calls=()):
+        self.clock = clock
+        self.retry_after_calls = set(retry_after_calls)
+        self.calls_count = 0
+        self.sent = []
+
+    def send_message(self, chat_id, text):
+        self.calls_count += 1
+        if self.calls_count in self.retry_after_calls:
+            raise RetryAfter(RETRY_AFTER)
+        self.sent.append((chat_id, self.clock.time()))
+
+
+class FollowUpsTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed')
+        self.redis_db = fakeredis.FakeRedis()
+        self.clock = SimulatedClock()
+        self.claim_due_follow_ups = self.redis_db.register_script(
+            follow_ups.CLAIM_DUE_FOLLOW_UPS_SCRIPT
+        )
+
+    def schedule(self, chat_id, delay):
+        follow_ups.schedule_follow_up(
+            self.redis_db,
+            chat_id,
+            delay,
+            clock=self.clock.time
+        )
+        return self.clock.time() + delay
+
+    def send_due(self, bot):
+        return follow_ups.send_due_follow_ups(
+            self.redis_db,
+            bot,
+            self.claim_due_follow_ups,
+            self.clock.time,
+            self.clock.sleep
+        )
+
+    def run_workers(self, bot):
+        while self.redis_db.zcard(follow_ups.FOLLOW_UPS_KEY):
+            # Workers take turns, as if they ran in separate processes.
+            sent_count = sum(
+                self.send_due(bot) for _ in range(WORKERS_COUNT)
+            )
+            if sent_count < follow_ups.BATCH_SIZE:
+                self.clock.sleep(follow_ups.POLL_INTERVAL)
+
+    def test_follow_ups_are_sent_once_in_time_and_within_rate(self):
+        random_generator = random.Random(1)
+        due_at = {}
+        # A burst due at once goes over the rate, the rest are spread.
+        for chat_id in range(BURST_FOLLOW_UPS_COUNT):
+            due_at[chat_id] = self.schedule(chat_id, 60)
+        for chat_id in range(
+            BURST_FOLLOW_UPS_COUNT,
+            BURST_FOLLOW_UPS_COUNT + SPREAD_FOLLOW_UPS_COUNT
+        ):
+            due_at[chat_id] = self.schedule(
+                chat_id,
+                random_generator.uniform(0, 600)
+            )
+        bot = RecordingBot(self.clock, retry_after_calls=[50, 250])
+
+        self.run_workers(bot)
+
+        sent_chat_ids = [chat_id for chat_id, _ in bot.sent]
+        self.assertEqual(sorted(sent_chat_ids), sorted(due_at))
+        for chat_id, sent_at in bot.sent:
+            self.assertGreaterEqual(sent_at, due_at[chat_id])
+        sent_per_second = Counter(int(sent_at) for _, sent_at in bot.sent)
+        self.assertLessEqual(
+            max(sent_per_second.values()),
+            follow_ups.SEND_RATE
+        )
+
+    def test_batch_is_postponed_after_retry_after(self):
+        chat_ids = list(range(10))
+        for chat_id in chat_ids:
+            self.schedule(chat_id, 0)
+        bot = RecordingBot(self.clock, retry_after_calls=[4])
+
+        sent_count = self.send_due(bot)
+
+        self.assertEqual(sent_count, 3)
+        self.assertEqual(len(bot.sent), 3)
+        postponed = self.redis_db.zrange(
+            follow_ups.FOLLOW_UPS_KEY,
+            0,
+            -1,
+            withscores=True
+        )
+        self.assertEqual(len(postponed), 7)
+        # Due right after the wait instead of after the claim timeout.
+        self.assertEqual(
+            {due_at for _, due_at in postponed},
+            {self.clock.time()}
+        )
+        retried_at = self.clock.time()
+
+        self.send_due(bot)
+
+        self.assertEqual(
+            sorted(chat_id for chat_id, _ in bot.sent),
+            chat_ids
+        )
+        self.assertTrue(all(
+            sent_at >= retried_at for _, sent_at in bot.sent[3:]
+        ))
+        self.assertEqual(self.redis_db.zcard(follow_ups.FOLLOW_UPS_KEY), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import random
+import unittest
+
+import numpy as np
+from geopy import distance
+
+from geo_distances import (RELATIVE_TOLERANCE,
+                           haversine_distances,
+                           pairwise_haversine_distances)
+
+POSITIONS_COUNT = 100
+# Moscow, where the pizzerias are, and the whole globe.
+AREAS = [
+    ((55.45, 56.05), (37.1, 38.1)),
+    ((-89.0, 89.0), (-180.0, 180.0)),
+]
+
+
+def get_random_positions(count, area, seed=1):
+    random_generator = random.Random(seed)
+    (min_lat, max_lat), (min_lon, max_lon) = area
+    return [
+        (
+            random_generator.uniform(min_lat, max_lat),
+            random_generator.uniform(min_lon, max_lon)
+        )
+        for _ in range(count)
+    ]
+
+
+class GeoDistancesTest(unittest.TestCase):
+    def test_haversine_is_within_tolerance_of_geodesic(self):
+        for area in AREAS:
+            origins = get_random_positions(POSITIONS_COUNT, area)
+            destinations = get_random_positions(POSITIONS_COUNT, area, seed=2)
+            distances = pairwise_haversine_distances(origins, destinations)
+            worst_error = 0
+            for origin_index, origin in enumerate(origins):
+                for destination_index, destination in enumerate(destinations):
+                    geodesic_km = distance.distance(origin, destination).km
+                    if not geodesic_km:
+                        continue
+                    haversine_km = distances[origin_index, destination_index]
+                    worst_error = max(
+                        worst_error,
+                        abs(haversine_km - geodesic_km) / geodesic_km
+                    )
+            self.assertLessEqual(worst_error, RELATIVE_TOLERANCE, area)
+
+    def test_one_origin_gives_the_pairwise_row(self):
+        area = AREAS[0]
+        origins = get_random_positions(10, area)
+        destinations = get_random_positions(50, area, seed=2)
+        pairwise_distances = pairwise_haversine_distances(
+            origins,
+            destinations
+        )
+        for origin, row in zip(origins, pairwise_distances):
+            np.testing.assert_allclose(
+                haversine_distances(origin, destinations),
+                row
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
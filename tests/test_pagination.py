@@ -0,0 +1,98 @@
+import os
+import unittest
+from unittest import mock
+
+import elastic_path_api
+from benchmarks.fake_upstreams import (FakeElasticPath,
+                                       make_random_pizzerias,
+                                       start_fake_upstream)
+
+ENTRIES_COUNT = 3000
+
+
+class RecordingElasticPath(FakeElasticPath):
+    def __init__(self, pizzerias, self_link_on_last_page=False):
+        super().__init__(pizzerias=pizzerias)
+        self.self_link_on_last_page = self_link_on_last_page
+        self.requested_offsets = []
+
+    def get_page(self, objects, query, base_url, path):
+        offset = int(query.get('page[offset]', [0])[0])
+        self.requested_offsets.append(offset)
+        page = super().get_page(objects, query, base_url, path)
+        if self.self_link_on_last_page and 'next' not in page['links']:
+            limit = page['meta']['page']['limit']
+            page['links']['next'] = (
+                f'{base_url}{path}?page[limit]={limit}'
+                f'&page[offset]={offset}'
+            )
+        return page
+
+
+class PaginationTest(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(elastic_path_api, 'ACCESS_TOKEN', None),
+            mock.patch.object(elastic_path_api, 'EXPIRATION_TIME', None),
+            mock.patch.dict(
+                elastic_path_api.TOKEN_STORAGE,
+                {'redis_db': None}
+            ),
+            mock.patch.dict(os.environ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def start_upstream(self, entries_count, self_link_on_last_page=False):
+        self.entries = make_random_pizzerias(entries_count)
+        self.upstream = RecordingElasticPath(
+            self.entries,
+            self_link_on_last_page
+        )
+        server, url = start_fake_upstream(self.upstream)
+        self.addCleanup(server.shutdown)
+        os.environ['ELASTIC_PATH_API_URL'] = url
+
+    def assert_every_entry_once_in_order(self, entries):
+        self.assertEqual(
+            [entry['id'] for entry in entries],
+            [entry['id'] for entry in self.entries]
+        )
+        # No page is fetched twice.
+        self.assertEqual(
+            len(self.upstream.requested_offsets),
+            len(set(self.upstream.requested_offsets))
+        )
+
+    def test_iterate_entries_streams_every_entry_once(self):
+        self.start_upstream(ENTRIES_COUNT)
+        self.assert_every_entry_once_in_order(
+            list(elastic_path_api.iterate_entries('pizzerias'))
+        )
+        self.assertEqual(
+            len(self.upstream.requested_offsets),
+            -(-ENTRIES_COUNT // elastic_path_api.PAGE_LIMIT)
+        )
+
+    def test_get_all_entries_returns_every_entry_once(self):
+        self.start_upstream(ENTRIES_COUNT)
+        self.assert_every_entry_once_in_order(
+            elastic_path_api.get_all_entries('pizzerias')
+        )
+
+    def test_next_link_to_the_current_page_ends_iteration(self):
+        self.start_upstream(ENTRIES_COUNT, self_link_on_last_page=True)
+        self.assert_every_entry_once_in_order(
+            elastic_path_api.get_all_entries('pizzerias')
+        )
+
+    def test_single_page_with_next_link_to_itself(self):
+        self.start_upstream(10, self_link_on_last_page=True)
+        self.assert_every_entry_once_in_order(
+            elastic_path_api.get_all_entries('pizzerias')
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
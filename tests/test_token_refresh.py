@@ -0,0 +1,107 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import elastic_path_api
+
+THREADS_COUNT = 20
+EXPIRIES_COUNT = 3
+TOKEN_LIFETIME = 3600
+
+
+class SimulatedTime:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class TokenRefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = SimulatedTime(1_000_000)
+        self.requests_count = 0
+        self.requests_lock = threading.Lock()
+        patches = [
+            mock.patch.object(elastic_path_api, 'time', self.clock),
+            mock.patch.object(
+                elastic_path_api,
+                'request_access_token',
+                self.request_access_token
+            ),
+            mock.patch.object(elastic_path_api, 'ACCESS_TOKEN', None),
+            mock.patch.object(elastic_path_api, 'EXPIRATION_TIME', None),
+            mock.patch.dict(elastic_path_api.TOKEN_STORAGE, {'redis_db': None}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def request_access_token(self):
+        with self.requests_lock:
+            self.requests_count += 1
+            token_number = self.requests_count
+        # Long enough for the other threads to pile up behind the lock.
+        time.sleep(0.05)
+        return f'token-{token_number}', self.clock.now + TOKEN_LIFETIME
+
+    def get_tokens_at_once(self):
+        barrier = threading.Barrier(THREADS_COUNT)
+        tokens = []
+        tokens_lock = threading.Lock()
+
+        def get_token():
+            barrier.wait()
+            token = elastic_path_api.get_elastic_path_access_token()
+            with tokens_lock:
+                tokens.append(token)
+
+        threads = [
+            threading.Thread(target=get_token) for _ in range(THREADS_COUNT)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return tokens
+
+    def test_one_refresh_per_expiry(self):
+        for expiry in range(1, EXPIRIES_COUNT + 1):
+            tokens = self.get_tokens_at_once()
+            self.assertEqual(self.requests_count, expiry)
+            self.assertEqual(set(tokens), {f'token-{expiry}'})
+            # Still fresh until the refresh margin, no new requests.
+            self.clock.now += \
+                TOKEN_LIFETIME - elastic_path_api.TOKEN_REFRESH_MARGIN - 1
+            self.get_tokens_at_once()
+            self.assertEqual(self.requests_count, expiry)
+            self.clock.now += 2
+
+    def test_background_refresh_skips_fresh_token(self):
+        margin = elastic_path_api.TOKEN_REFRESH_MARGIN
+        with mock.patch.object(elastic_path_api, 'schedule_token_refresh'):
+            elastic_path_api.get_elastic_path_access_token()
+            # The first timer fires a margin after the start.
+            self.clock.now += margin
+            elastic_path_api.refresh_token_in_background()
+            self.assertEqual(self.requests_count, 1)
+            self.clock.now += TOKEN_LIFETIME - 3 * margin
+            elastic_path_api.refresh_token_in_background()
+            self.assertEqual(self.requests_count, 2)
+
+    def test_one_refresh_per_expiry_with_shared_token(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest('fakeredis is not installed')
+        elastic_path_api.TOKEN_STORAGE['redis_db'] = fakeredis.FakeRedis()
+        for expiry in range(1, EXPIRIES_COUNT + 1):
+            tokens = self.get_tokens_at_once()
+            self.assertEqual(self.requests_count, expiry)
+            self.assertEqual(set(tokens), {f'token-{expiry}'})
+            self.clock.now += TOKEN_LIFETIME
+
+
+if __name__ == '__main__':
+    unittest.main()
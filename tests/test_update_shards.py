@@ -0,0 +1,251 @@
+import json
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+
+import redis
+from redis.lock import Lock
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, TypeHandler
+
+import update_queue
+from update_queue import enqueue_update, get_queue_key, run_update_worker
+
+SHARDS_COUNT = 2
+USERS_COUNT = 10
+UPDATES_PER_USER = 20
+RESULTS_KEY = 'test:handled_updates'
+BLOCKED_KEY = 'test:blocked'
+LOCK_TIMEOUT = 3
+
+
+def start_redis():
+    # REDIS_URL points to a disposable database, it is flushed.
+    redis_url = os.getenv('REDIS_URL')
+    if redis_url:
+        return None, redis_url
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        return None, None
+    server = TcpFakeServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f'redis://{host}:{port}/0'
+
+
+def make_update(update_id, user_id, number):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': number,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Гость'},
+            'text': str(number),
+        },
+    }
+
+
+def record_update(update, context, redis_db, shard, block_on,
+                  block_seconds):
+    number = int(update.message.text)
+    if number == block_on and redis_db.set(BLOCKED_KEY, 1, nx=True):
+        # A slow update, or one the worker is killed in the middle of.
+        time.sleep(block_seconds)
+    redis_db.rpush(RESULTS_KEY, json.dumps(
+        [update.effective_user.id, number, shard]
+    ))
+
+
+def run_shard_worker(redis_url, shard, block_on=None, block_seconds=60):
+    update_queue.SHARD_LOCK_TIMEOUT = LOCK_TIMEOUT
+    update_queue.QUEUE_TIMEOUT = 1
+    redis_db = redis.Redis.from_url(redis_url)
+    dispatcher = Dispatcher(Bot('123456:test'), None, workers=0)
+    dispatcher.add_handler(TypeHandler(
+        Update,
+        lambda update, context: record_update(
+            update,
+            context,
+            redis_db,
+            shard,
+            block_on,
+            block_seconds
+        )
+    ))
+    while True:
+        try:
+            # Returns when the worker lost the shard lock.
+            return run_update_worker(redis_db, dispatcher, shard)
+        except RuntimeError:
+            # The shard is busy or the lock of a killed worker has not
+            # expired yet.
+            time.sleep(0.2)
+
+
+class UpdateShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.server, redis_url = start_redis()
+        if redis_url is None:
+            self.skipTest('set REDIS_URL or install fakeredis with '
+                          'TcpFakeServer')
+        self.redis_url = redis_url
+        self.redis_db = redis.Redis.from_url(redis_url)
+        self.redis_db.flushdb()
+        # Workers load the lock scripts at the same time otherwise, which
+        # the fake server does not always survive.
+        for script in (Lock.LUA_RELEASE_SCRIPT, Lock.LUA_EXTEND_SCRIPT,
+                       Lock.LUA_REACQUIRE_SCRIPT):
+            self.redis_db.script_load(script)
+        self.processes = []
+        self.multiprocessing = multiprocessing.get_context('spawn')
+        if self.server is not None:
+            self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.stop_workers)
+
+    def start_worker(self, shard, block_on=None, block_seconds=60):
+        process = self.multiprocessing.Process(
+            target=run_shard_worker,
+            args=(self.redis_url, shard, block_on, block_seconds),
+            daemon=True
+        )
+        process.start()
+        self.processes.append(process)
+        return process
+
+    def stop_workers(self):
+        for process in self.processes:
+            process.kill()
+            process.join()
+
+    def wait_for_results(self, count, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.redis_db.llen(RESULTS_KEY) >= count:
+                break
+            time.sleep(0.05)
+        return [
+            json.loads(result)
+            for result in self.redis_db.lrange(RESULTS_KEY, 0, -1)
+        ]
+
+    def test_updates_of_every_user_are_handled_in_order(self):
+        user_ids = range(100, 100 + USERS_COUNT)
+        update_id = 0
+        for number in range(UPDATES_PER_USER):
+            for user_id in user_ids:
+                update_id += 1
+                enqueue_update(
+                    self.redis_db,
+                    make_update(update_id, user_id, number),
+                    SHARDS_COUNT
+                )
+        for shard in range(SHARDS_COUNT):
+            self.start_worker(shard)
+
+        results = self.wait_for_results(USERS_COUNT * UPDATES_PER_USER)
+
+        self.assertEqual(len(results), USERS_COUNT * UPDATES_PER_USER)
+        for user_id in user_ids:
+            user_results = [
+                (number, shard) for result_user_id, number, shard in results
+                if result_user_id == user_id
+            ]
+            self.assertEqual(
+                [number for number, _ in user_results],
+                list(range(UPDATES_PER_USER))
+            )
+            self.assertEqual(
+                {shard for _, shard in user_results},
+                {user_id % SHARDS_COUNT}
+            )
+
+    def enqueue_user_updates(self, user_id, count):
+        for number in range(count):
+            enqueue_update(
+                self.redis_db,
+                make_update(number + 1, user_id, number),
+                SHARDS_COUNT
+            )
+
+    def test_slow_update_keeps_the_shard(self):
+        user_id = 100
+        shard = user_id % SHARDS_COUNT
+        self.enqueue_user_updates(user_id, 5)
+        # The update takes twice the lock timeout while a second worker
+        # keeps trying to take the shard.
+        self.start_worker(shard, block_on=2, block_seconds=2 * LOCK_TIMEOUT)
+        self.wait_for_results(2)
+        self.start_worker(shard)
+
+        results = self.wait_for_results(5)
+        time.sleep(LOCK_TIMEOUT)
+
+        self.assertEqual(
+            [number for _, number, _ in results],
+            [0, 1, 2, 3, 4]
+        )
+        self.assertEqual(self.redis_db.llen(RESULTS_KEY), 5)
+
+    def test_worker_stops_when_the_lock_is_lost(self):
+        user_id = 100
+        shard = user_id % SHARDS_COUNT
+        self.enqueue_user_updates(user_id, 5)
+        worker = self.start_worker(
+            shard,
+            block_on=2,
+            block_seconds=2 * LOCK_TIMEOUT
+        )
+        self.wait_for_results(2)
+        # As if the lock expired while Redis or the worker was paused.
+        self.redis_db.delete(f'{get_queue_key(shard)}:worker')
+        worker.join(timeout=4 * LOCK_TIMEOUT)
+
+        self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(
+            [number for _, number, _ in self.wait_for_results(3)],
+            [0, 1, 2]
+        )
+        self.assertEqual(
+            self.redis_db.llen(f'{get_queue_key(shard)}:processing'),
+            0
+        )
+
+        self.start_worker(shard)
+        results = self.wait_for_results(5)
+
+        self.assertEqual(
+            [number for _, number, _ in results],
+            [0, 1, 2, 3, 4]
+        )
+
+    def test_updates_of_killed_worker_are_handled_again(self):
+        user_id = 100
+        shard = user_id % SHARDS_COUNT
+        self.enqueue_user_updates(user_id, 5)
+        killed_worker = self.start_worker(shard, block_on=2)
+        self.wait_for_results(2)
+        processing_key = f'{get_queue_key(shard)}:processing'
+        deadline = time.monotonic() + 10
+        while not self.redis_db.llen(processing_key) and \
+                time.monotonic() < deadline:
+            time.sleep(0.05)
+        killed_worker.kill()
+        killed_worker.join()
+        self.assertEqual(self.redis_db.llen(processing_key), 1)
+
+        self.start_worker(shard)
+        results = self.wait_for_results(5)
+
+        self.assertEqual(
+            [number for _, number, _ in results],
+            [0, 1, 2, 3, 4]
+        )
+        self.assertEqual(self.redis_db.llen(processing_key), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
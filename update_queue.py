@@ -0,0 +1,132 @@
+import json
+import logging
+import threading
+
+from redis.exceptions import LockError, RedisError
+from telegram import Update
+
+DEFAULT_SHARDS_COUNT = 8
+QUEUE_TIMEOUT = 5
+SHARD_LOCK_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def get_update_user_id(update_data):
+    for update_type, update_object in update_data.items():
+        if not isinstance(update_object, dict):
+            continue
+        if 'from' in update_object:
+            return update_object['from']['id']
+        if 'chat' in update_object:
+            return update_object['chat']['id']
+    return None
+
+
+def get_update_shard(update_data, shards_count):
+    # All updates of one user go to one shard, and every shard has a
+    # single worker, so a user's updates are handled in order.
+    user_id = get_update_user_id(update_data)
+    if user_id is None:
+        return 0
+    return user_id % shards_count
+
+
+def get_queue_key(shard):
+    return f'updates:{shard}'
+
+
+def enqueue_update(redis_db, update_data, shards_count):
+    shard = get_update_shard(update_data, shards_count)
+    redis_db.lpush(get_queue_key(shard), json.dumps(update_data))
+    return shard
+
+
+def requeue_unfinished_updates(redis_db, shard):
+    queue_key = get_queue_key(shard)
+    processing_key = f'{queue_key}:processing'
+    unfinished_updates = redis_db.lrange(processing_key, 0, -1)
+    pipeline = redis_db.pipeline()
+    for update in unfinished_updates:
+        pipeline.rpush(queue_key, update)
+    pipeline.delete(processing_key)
+    pipeline.execute()
+    return len(unfinished_updates)
+
+
+def keep_shard_lock(shard_lock, shard, stopped, lock_lost):
+    # One update may take longer than the lock timeout: several upstream
+    # timeouts and retries, a photo download, waits for flood limits. The
+    # lock is extended while the update is handled, not only between them.
+    while not stopped.wait(SHARD_LOCK_TIMEOUT / 3):
+        try:
+            shard_lock.reacquire()
+        except LockError:
+            lock_lost.set()
+            return
+        except RedisError:
+            logger.warning(
+                'Could not extend the lock of shard %s',
+                shard,
+                exc_info=True
+            )
+
+
+def run_update_worker(redis_db, dispatcher, shard):
+    queue_key = get_queue_key(shard)
+    processing_key = f'{queue_key}:processing'
+    shard_lock = redis_db.lock(
+        f'{queue_key}:worker',
+        timeout=SHARD_LOCK_TIMEOUT,
+        # The lock is extended from another thread.
+        thread_local=False
+    )
+    if not shard_lock.acquire(blocking=False):
+        raise RuntimeError(f'Shard {shard} already has a worker')
+    stopped = threading.Event()
+    lock_lost = threading.Event()
+    lock_keeper = threading.Thread(
+        target=keep_shard_lock,
+        args=(shard_lock, shard, stopped, lock_lost),
+        name=f'shard-{shard}-lock',
+        daemon=True
+    )
+    lock_keeper.start()
+    try:
+        requeued_count = requeue_unfinished_updates(redis_db, shard)
+        if requeued_count:
+            logger.warning(
+                'Requeued %s unfinished updates of shard %s',
+                requeued_count,
+                shard
+            )
+        while not lock_lost.is_set():
+            raw_update = redis_db.brpoplpush(
+                queue_key,
+                processing_key,
+                timeout=QUEUE_TIMEOUT
+            )
+            if raw_update is None:
+                continue
+            if lock_lost.is_set():
+                # Another worker may have the shard now, the update goes
+                # back to the front of the queue for it.
+                pipeline = redis_db.pipeline()
+                pipeline.lrem(processing_key, 1, raw_update)
+                pipeline.rpush(queue_key, raw_update)
+                pipeline.execute()
+                break
+            update = Update.de_json(json.loads(raw_update), dispatcher.bot)
+            try:
+                dispatcher.process_update(update)
+            finally:
+                redis_db.lrem(processing_key, 1, raw_update)
+        logger.error('Shard %s lock was lost, the worker stops', shard)
+    finally:
+        stopped.set()
+        lock_keeper.join()
+        try:
+            shard_lock.release()
+        except LockError:
+            # Already taken by another worker or expired.
+            pass
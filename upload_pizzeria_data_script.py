@@ -1,93 +1,384 @@
+import argparse
 import json
+import sys
 from pathlib import Path
 
+import requests
 from dotenv import load_dotenv
 
-from elastic_path_api import (create_product,
+from bulk_import import BulkImporter
+from catalog_sync import (get_product_fields,
+                          get_main_image_url,
+                          get_changed_fields,
+                          get_entry_fields,
+                          plan_sync)
+from elastic_path_api import (fetch_products,
+                              fetch_files,
+                              fetch_flows,
+                              get_all_entries,
+                              get_product_payload,
+                              create_product,
+                              find_product_by_slug,
+                              update_product,
+                              delete_product,
                               create_image,
                               set_product_main_image,
                               create_flow,
                               create_flow_field,
-                              create_flow_entry)
+                              create_flow_entry,
+                              update_flow_entry,
+                              delete_flow_entry)
+
+PIZZERIAS_FLOW_FIELDS = [
+    {
+        'name': 'alias',
+        'description': 'pizzeria name',
+        'type': 'string'
+    },
+    {
+        'name': 'address',
+        'description': 'pizzeria address',
+        'type': 'string'
+    },
+    {
+        'name': 'lon',
+        'description': 'longitude',
+        'type': 'float'
+    },
+    {
+        'name': 'lat',
+        'description': 'latitude',
+        'type': 'float'
+    },
+    {
+        'name': 'delivery_chat_id',
+        'description': 'chat id for delivery notifications',
+        'type': 'integer'
+    }
+]
+CUSTOMER_FIELDS = [
+    {
+        'name': 'lon',
+        'description': 'customer location longitude',
+        'type': 'float'
+    },
+    {
+        'name': 'lat',
+        'description': 'customer location latitude',
+        'type': 'float'
+    }
+]
+
+
+PIZZERIA_FIELD_NAMES = [field['name'] for field in PIZZERIAS_FLOW_FIELDS]
+
+
+def get_pizzeria_flow_fields(pizzeria):
+    return {
+        'alias': pizzeria['alias'],
+        'address': pizzeria['address']['full'],
+        'lon': float(pizzeria['coordinates']['lon']),
+        'lat': float(pizzeria['coordinates']['lat']),
+        'delivery_chat_id': 30952486
+    }
+
+
+def create_or_find_product(product):
+    # The product may have been created by a run whose request timed out
+    # before its id got into the checkpoint, its slug is taken then.
+    try:
+        return create_product(product)
+    except requests.HTTPError as error:
+        if error.response is None or error.response.status_code != 409:
+            raise
+        product_id = find_product_by_slug(str(product['id']))
+        if product_id is None:
+            raise
+        return product_id
+
+
+def upload_product(importer, product):
+    product_key = f'product:{product["id"]}'
+    product_id = importer.call(
+        product_key,
+        'products',
+        create_or_find_product,
+        product,
+        idempotent=False
+    )
+    upload_main_image(
+        importer,
+        product_key,
+        product_id,
+        product['product_image']['url']
+    )
+
+
+def upload_main_image(importer, product_key, product_id, image_url):
+    image_id = importer.call(
+        f'{product_key}:image',
+        'files',
+        create_image,
+        image_url,
+        idempotent=False
+    )
+    importer.call(
+        f'{product_key}:main_image',
+        'products',
+        set_product_main_image,
+        product_id,
+        image_id
+    )
+
+
+def update_changed_product(importer, product_id, product, changed_fields):
+    product_key = f'product:{product["id"]}'
+    if changed_fields - {'image_url'}:
+        importer.call(
+            f'{product_key}:update',
+            'products',
+            update_product,
+            product_id,
+            product
+        )
+    if 'image_url' in changed_fields:
+        upload_main_image(
+            importer,
+            product_key,
+            product_id,
+            product['product_image']['url']
+        )
+
+
+def upload_flow_field(importer, flow_key, flow_id, field):
+    importer.call(
+        f'{flow_key}:field:{field["name"]}',
+        'fields',
+        create_flow_field,
+        flow_id,
+        field,
+        idempotent=False
+    )
+
+
+def upload_pizzeria(importer, pizzeria):
+    flow_fields = get_pizzeria_flow_fields(pizzeria)
+    importer.call(
+        f'flow:pizzerias:entry:{pizzeria["id"]}',
+        'entries',
+        create_flow_entry,
+        'pizzerias',
+        flow_fields,
+        idempotent=False
+    )
+
+
+def upload_flow(importer, flow_key, flow_name, flow_description, fields):
+    flow_id = importer.call(
+        flow_key,
+        'flows',
+        create_flow,
+        flow_name,
+        flow_description,
+        idempotent=False
+    )
+    return importer.run(
+        f'{flow_name} flow fields',
+        [
+            (upload_flow_field, importer, flow_key, flow_id, field)
+            for field in fields
+        ]
+    )
+
+
+def upload_all(importer, products, pizzerias):
+    failed_tasks = importer.run(
+        'products',
+        [(upload_product, importer, product) for product in products]
+    )
+    failed_tasks += upload_flow(
+        importer,
+        'flow:pizzerias',
+        'pizzerias',
+        'pizzerias addresses and geolocation',
+        PIZZERIAS_FLOW_FIELDS
+    )
+    failed_tasks += importer.run(
+        'pizzerias',
+        [(upload_pizzeria, importer, pizzeria) for pizzeria in pizzerias]
+    )
+    failed_tasks += upload_flow(
+        importer,
+        'flow:customers',
+        'Customers',
+        'Extends the default customer model',
+        CUSTOMER_FIELDS
+    )
+    return failed_tasks
+
+
+def sync_products(importer, products):
+    products_by_slug = {str(product['id']): product for product in products}
+    desired_products = {
+        slug: get_product_fields(
+            get_product_payload(product)['data'],
+            product['product_image']['url']
+        )
+        for slug, product in products_by_slug.items()
+    }
+    file_urls = {
+        file_data['id']: file_data['link']['href']
+        for file_data in fetch_files()
+    }
+    upstream_products = [
+        (
+            product['slug'],
+            product['id'],
+            get_product_fields(product, get_main_image_url(product, file_urls))
+        )
+        for product in fetch_products()
+    ]
+    upstream_fields = {
+        product_id: fields for _, product_id, fields in upstream_products
+    }
+    slugs_to_create, products_to_update, ids_to_delete = plan_sync(
+        desired_products,
+        upstream_products
+    )
+    failed_tasks = importer.run(
+        'created products',
+        [
+            (upload_product, importer, products_by_slug[slug])
+            for slug in slugs_to_create
+        ]
+    )
+    failed_tasks += importer.run(
+        'updated products',
+        [
+            (update_changed_product, importer, product_id,
+             products_by_slug[slug],
+             get_changed_fields(
+                 desired_products[slug],
+                 upstream_fields[product_id]
+             ))
+            for slug, product_id in products_to_update
+        ]
+    )
+    failed_tasks += importer.run(
+        'deleted products',
+        [
+            (importer.call, f'product:{product_id}:delete', 'products',
+             delete_product, product_id)
+            for product_id in ids_to_delete
+        ]
+    )
+    return failed_tasks
+
+
+def sync_pizzerias(importer, pizzerias):
+    pizzerias_by_alias = {
+        pizzeria['alias']: pizzeria for pizzeria in pizzerias
+    }
+    desired_entries = {
+        alias: get_pizzeria_flow_fields(pizzeria)
+        for alias, pizzeria in pizzerias_by_alias.items()
+    }
+    upstream_entries = [
+        (entry['alias'], entry['id'],
+         get_entry_fields(entry, PIZZERIA_FIELD_NAMES))
+        for entry in get_all_entries('pizzerias')
+    ]
+    aliases_to_create, entries_to_update, ids_to_delete = plan_sync(
+        desired_entries,
+        upstream_entries
+    )
+    failed_tasks = importer.run(
+        'created pizzerias',
+        [
+            (upload_pizzeria, importer, pizzerias_by_alias[alias])
+            for alias in aliases_to_create
+        ]
+    )
+    failed_tasks += importer.run(
+        'updated pizzerias',
+        [
+            (importer.call, f'flow:pizzerias:entry:{entry_id}:update',
+             'entries', update_flow_entry, 'pizzerias', entry_id,
+             desired_entries[alias])
+            for alias, entry_id in entries_to_update
+        ]
+    )
+    failed_tasks += importer.run(
+        'deleted pizzerias',
+        [
+            (importer.call, f'flow:pizzerias:entry:{entry_id}:delete',
+             'entries', delete_flow_entry, 'pizzerias', entry_id)
+            for entry_id in ids_to_delete
+        ]
+    )
+    return failed_tasks
+
+
+def sync_all(importer, products, pizzerias):
+    failed_tasks = sync_products(importer, products)
+    flow_slugs = {flow['slug'] for flow in fetch_flows()}
+    if 'pizzerias' not in flow_slugs:
+        failed_tasks += upload_flow(
+            importer,
+            'flow:pizzerias',
+            'pizzerias',
+            'pizzerias addresses and geolocation',
+            PIZZERIAS_FLOW_FIELDS
+        )
+    failed_tasks += sync_pizzerias(importer, pizzerias)
+    if 'Customers' not in flow_slugs:
+        failed_tasks += upload_flow(
+            importer,
+            'flow:customers',
+            'Customers',
+            'Extends the default customer model',
+            CUSTOMER_FIELDS
+        )
+    return failed_tasks
 
 
 def main():
     load_dotenv()
+    parser = argparse.ArgumentParser(
+        description='Upload menu and pizzerias to Elastic Path'
+    )
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of parallel requests')
+    parser.add_argument('--rate-limit', type=float, default=10,
+                        help='requests per second for every endpoint')
+    parser.add_argument('--checkpoint', default='upload_checkpoint.json',
+                        help='file with already uploaded objects')
+    parser.add_argument('--sync', action='store_true',
+                        help='compare with the store and only upload '
+                             'changes')
+    args = parser.parse_args()
+    importer = BulkImporter(
+        None if args.sync else args.checkpoint,
+        workers=args.workers,
+        rate_limit=args.rate_limit
+    )
 
     with open('menu.json', 'r', encoding='utf-8') as menu_file:
         products = json.load(menu_file)
+    with open('addresses.json', 'r', encoding='utf-8') as addresses_file:
+        pizzerias = json.load(addresses_file)
     image_directory = Path('./images')
     Path.mkdir(image_directory, exist_ok=True)
-    for product in products:
-        product_id = create_product(product)
-        image_url = product['product_image']['url']
-        image_id = create_image(image_url)
-        set_product_main_image(product_id, image_id)
-
-    pizzerias_flow_id = create_flow(
-        'pizzerias',
-        'pizzerias addresses and geolocation'
-    )
-    pizzerias_flow_fields = [
-        {
-            'name': 'alias',
-            'description': 'pizzeria name',
-            'type': 'string'
-        },
-        {
-            'name': 'address',
-            'description': 'pizzeria address',
-            'type': 'string'
-        },
-        {
-            'name': 'lon',
-            'description': 'longitude',
-            'type': 'float'
-        },
-        {
-            'name': 'lat',
-            'description': 'latitude',
-            'type': 'float'
-        },
-        {
-            'name': 'delivery_chat_id',
-            'description': 'chat id for delivery notifications',
-            'type': 'integer'
-        }
-    ]
-    for field in pizzerias_flow_fields:
-        create_flow_field(pizzerias_flow_id, field)
+    if args.sync:
+        failed_tasks = sync_all(importer, products, pizzerias)
+    else:
+        failed_tasks = upload_all(importer, products, pizzerias)
 
-    with open('addresses.json', 'r', encoding='utf-8') as addresses_file:
-        pizzerias = json.load(addresses_file)
-    for pizzeria in pizzerias:
-        flow_fields = {
-            'alias': pizzeria['alias'],
-            'address': pizzeria['address']['full'],
-            'lon': float(pizzeria['coordinates']['lon']),
-            'lat': float(pizzeria['coordinates']['lat']),
-            'delivery_chat_id': 30952486
-        }
-        create_flow_entry('pizzerias', flow_fields)
-
-    customers_flow_id = create_flow(
-        'Customers',
-        'Extends the default customer model'
-    )
-    customer_fields = [
-        {
-            'name': 'lon',
-            'description': 'customer location longitude',
-            'type': 'float'
-        },
-        {
-            'name': 'lat',
-            'description': 'customer location latitude',
-            'type': 'float'
-        }
-    ]
-    for field in customer_fields:
-        create_flow_field(customers_flow_id, field)
+    if failed_tasks:
+        sys.exit(
+            f'{len(failed_tasks)} uploads failed, run the script again '
+            'to retry them'
+        )
 
 
 if __name__ == '__main__':
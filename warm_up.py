@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_PHASE_RETRY_INTERVAL = 5
+
+WARM_UP = {
+    'phases': {},
+    'required_phases': set(),
+    'started_at': None,
+    'seconds': None,
+}
+WARM_UP_LOCK = threading.Lock()
+WARM_UP_FINISHED = threading.Event()
+
+
+def run_warm_up_phase(phase_name, warm_up_function, *args):
+    with WARM_UP_LOCK:
+        required = phase_name in WARM_UP['required_phases']
+    started_at = time.monotonic()
+    while True:
+        with WARM_UP_LOCK:
+            WARM_UP['phases'][phase_name]['status'] = 'running'
+        try:
+            warm_up_function(*args)
+        except Exception:
+            logger.exception('Warm-up phase %s failed', phase_name)
+            status = 'failed'
+        else:
+            status = 'done'
+        seconds = round(time.monotonic() - started_at, 3)
+        with WARM_UP_LOCK:
+            WARM_UP['phases'][phase_name] = {
+                'status': status,
+                'seconds': seconds
+            }
+        logger.info(
+            'Warm-up phase %s %s in %.3f s',
+            phase_name,
+            status,
+            seconds
+        )
+        # The bot still works without the cache of an optional phase, it
+        # is filled lazily by the first update that needs it. The bot is
+        # not ready without a required one, so it is tried again.
+        if status == 'done' or not required:
+            return
+        time.sleep(REQUIRED_PHASE_RETRY_INTERVAL)
+
+
+def warm_up(phases):
+    started_at = time.monotonic()
+    with ThreadPoolExecutor(
+        max_workers=len(phases),
+        thread_name_prefix='warm-up'
+    ) as executor:
+        for phase_name, warm_up_function, *args in phases:
+            executor.submit(
+                run_warm_up_phase,
+                phase_name,
+                warm_up_function,
+                *args
+            )
+    seconds = round(time.monotonic() - started_at, 3)
+    with WARM_UP_LOCK:
+        WARM_UP['seconds'] = seconds
+    WARM_UP_FINISHED.set()
+    logger.info('Warm-up finished in %.3f s', seconds)
+
+
+def start_warm_up(phases, required_phases=()):
+    # phases is a list of (name, function, *args), all of them run at
+    # once. A phase that needs another one's data should call the same
+    # cached getter, the caches already let one caller fetch at a time.
+    with WARM_UP_LOCK:
+        WARM_UP['started_at'] = time.time()
+        WARM_UP['required_phases'] = set(required_phases)
+        for phase_name, *_ in phases:
+            WARM_UP['phases'][phase_name] = {
+                'status': 'pending',
+                'seconds': None
+            }
+    thread = threading.Thread(
+        target=warm_up,
+        args=(phases,),
+        name='warm-up',
+        daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def is_phase_missing(phase_name):
+    # Must be called with WARM_UP_LOCK held.
+    phase = WARM_UP['phases'].get(phase_name)
+    return phase is None or phase['status'] != 'done'
+
+
+def is_ready():
+    if not WARM_UP_FINISHED.is_set():
+        return False
+    with WARM_UP_LOCK:
+        return not any(
+            is_phase_missing(phase_name)
+            for phase_name in WARM_UP['required_phases']
+        )
+
+
+def get_warm_up_report():
+    ready = is_ready()
+    with WARM_UP_LOCK:
+        return {
+            'ready': ready,
+            'seconds': WARM_UP['seconds'],
+            'required_phases': sorted(WARM_UP['required_phases']),
+            'phases': {
+                phase_name: dict(phase)
+                for phase_name, phase in WARM_UP['phases'].items()
+            },
+        }
@@ -0,0 +1,25 @@
+import argparse
+
+from dotenv import load_dotenv
+
+from product_images import warm_up_product_images
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description='Download and prepare all product images in advance'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=8,
+        help='number of images processed in parallel'
+    )
+    args = parser.parse_args()
+    image_paths = warm_up_product_images(workers=args.workers)
+    print(f'{len(image_paths)} product images are ready')
+
+
+if __name__ == '__main__':
+    main()
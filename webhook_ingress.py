@@ -0,0 +1,71 @@
+import json
+import logging
+import os
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import redis
+from dotenv import load_dotenv
+from telegram import Bot
+
+from update_queue import DEFAULT_SHARDS_COUNT, enqueue_update
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def __init__(self, *args, redis_db, webhook_path, shards_count,
+                 **kwargs):
+        self.redis_db = redis_db
+        self.webhook_path = webhook_path
+        self.shards_count = shards_count
+        super().__init__(*args, **kwargs)
+
+    def do_POST(self):
+        if self.path != self.webhook_path:
+            self.send_response(404)
+            self.end_headers()
+            return
+        content_length = int(self.headers.get('Content-Length', 0))
+        try:
+            update_data = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+        enqueue_update(self.redis_db, update_data, self.shards_count)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    tg_bot_token = os.getenv('TG_BOT_TOKEN')
+    webhook_url = os.getenv('TG_WEBHOOK_URL')
+    webhook_secret = os.getenv('TG_WEBHOOK_SECRET')
+    webhook_port = int(os.getenv('TG_WEBHOOK_PORT', 8443))
+    shards_count = int(os.getenv('UPDATE_SHARDS', DEFAULT_SHARDS_COUNT))
+    redis_instance = redis.Redis(
+        host=os.getenv('REDIS_DB_HOST'),
+        port=int(os.getenv('REDIS_DB_PORT')),
+        password=os.getenv('REDIS_DB_PASSWORD')
+    )
+    webhook_path = f'/webhook/{webhook_secret}'
+    Bot(tg_bot_token).set_webhook(f'{webhook_url}{webhook_path}')
+    handler = partial(
+        WebhookHandler,
+        redis_db=redis_instance,
+        webhook_path=webhook_path,
+        shards_count=shards_count
+    )
+    server = ThreadingHTTPServer(('', webhook_port), handler)
+    logger.info('Webhook ingress is listening on port %s', webhook_port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()